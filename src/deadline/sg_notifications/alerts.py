@@ -1,9 +1,15 @@
 import logging
 import logutil
+import re
+import threading
 
 import shotgun_api3
 
 import credentials
+import group_index
+import quarantine
+import thresholds
+import tracing
 
 # Logging to file
 logutil.add_file_handler()
@@ -25,6 +31,29 @@ DC_BUDGET_ACTION_NONE = "NONE"
 DC_BUDGET_ACTION_STOP_SCHEDULING_AND_CANCEL_TASKS = "STOP_SCHEDULING_AND_CANCEL_TASKS"
 DC_BUDGET_ACTION_STOP_SCHEDULING_AND_COMPLETE_TASKS = "STOP_SCHEDULING_AND_COMPLETE_TASKS"
 
+# Fields of the notification Groups used by the notifier
+GROUP_FIELDS = ["code", "sg_group_project"]
+
+# Machine-readable marker appended to each alert Note, used to rebuild the alert ledger
+ALERT_MARKER_PREFIX = "[deadline-cloud-alert"
+ALERT_MARKER_PATTERN = re.compile(r"\[deadline-cloud-alert budget:(\S+) limit:(\S+) threshold:(\S+)\]")
+
+# Seconds before a ShotGrid request gives up, so a hung call can't hold a farm scan's worker
+DEFAULT_SHOTGRID_TIMEOUT = 30
+
+# Notes read per ShotGrid request when searching for alert markers
+NOTE_PAGE_SIZE = 500
+
+_group_index = None
+_group_index_lock = threading.Lock()
+
+_quarantine = None
+_quarantine_lock = threading.Lock()
+
+
+class UnroutableQueueError(Exception):
+    """Raised when a queue's alerts can't be addressed to a ShotGrid Group and Project."""
+
 
 def get_shotgun(url=None, login=None, password=None, script_name=None, api_key=None):
     """
@@ -46,11 +75,15 @@ def get_shotgun(url=None, login=None, password=None, script_name=None, api_key=N
     
     if script_name:
         api_key = api_key or credentials.get_credential("shotgrid", "api_key")
-        
+    
+    timeout_secs = credentials.get_credential("shotgrid", "timeout_secs", optional=True) or DEFAULT_SHOTGRID_TIMEOUT
+    
     # Prefer ScriptUser authentication
     if script_name and api_key:
         try:
-            sg = shotgun_api3.Shotgun(url, script_name=script_name, api_key=api_key)
+            # Connect on the first request, once the timeout is set
+            sg = shotgun_api3.Shotgun(url, script_name=script_name, api_key=api_key, connect=False)
+            sg.config.timeout_secs = timeout_secs
             return sg
         except:
             raise
@@ -61,7 +94,8 @@ def get_shotgun(url=None, login=None, password=None, script_name=None, api_key=N
     
     if login and password:
         try:
-            sg = shotgun_api3.Shotgun(url, login=login, password=password)
+            sg = shotgun_api3.Shotgun(url, login=login, password=password, connect=False)
+            sg.config.timeout_secs = timeout_secs
             return sg
         except:
             raise
@@ -71,11 +105,27 @@ def get_shotgun(url=None, login=None, password=None, script_name=None, api_key=N
     return None
 
 
-def send_budget_alert_note(farm_id=None, farm_name=None, farm_hostname=None, queue_name=None, budget_id=None, budget_limit=None, default_budget_action=None):
+def get_traced_shotgun():
+    """
+    Get a connection to ShotGrid from get_shotgun whose calls are recorded as trace spans.
+    
+    Returns a traced Shotgun Client connection, or None if one couldn't be made.
+    
+    """
+    
+    sg = get_shotgun()
+    if sg is None:
+        return None
+    
+    return tracing.TracedClient(sg, "shotgrid")
+
+
+def send_budget_alert_note(farm_id=None, farm_name=None, farm_hostname=None, queue_name=None, budget_id=None, budget_limit=None, default_budget_action=None, threshold=100, marker=None, queue_id=None):
     """
     Create a budget notification addressed to a list of users on a ShotGrid project.
     
-    Returns the created Note entity.
+    Returns the created Note entity, or raises UnroutableQueueError if the queue has no
+    Group with a Group Project. Such queues are quarantined and skipped until they're checked again.
     
     Args:
         farm_id: Deadline Cloud farm ID
@@ -85,11 +135,100 @@ def send_budget_alert_note(farm_id=None, farm_name=None, farm_hostname=None, que
         budget_id: Deadline Cloud budget ID
         budget_limit: Deadline Cloud budget approximateDollarLimit
         default_budget_action: Deadline Cloud budget defaultBudgetAction
+        threshold: alert tier reached, as a percentage of budget_limit
+        marker: idempotency marker from format_alert_marker to append to the Note
+        queue_id: Deadline Cloud queue ID, used to quarantine the queue if it can't be routed
+    """
+    
+    # Skip queues that recently couldn't be routed, without looking up their Group
+    entry = get_quarantine().get_entry(queue_id) if queue_id else None
+    if entry:
+        raise UnroutableQueueError(f"Queue {queue_name} is quarantined: {entry['reason']}")
+    
+    note_subject, note_text = format_budget_alert(
+        farm_id=farm_id,
+        farm_name=farm_name,
+        farm_hostname=farm_hostname,
+        queue_name=queue_name,
+        budget_id=budget_id,
+        budget_limit=budget_limit,
+        default_budget_action=default_budget_action,
+        threshold=threshold
+    )
+    
+    if marker:
+        note_text += f"\n\n{marker}"
+    
+    try:
+        group = get_queue_group(queue_name)
+        logger.debug(f"group: {group}")
+    except:
+        raise
+    
+    if group is None:
+        reason = "no notification Group found"
+    elif not group.get("sg_group_project"):
+        reason = f"Group {group['code']} has no Group Project"
+    else:
+        reason = None
+    
+    if reason:
+        if queue_id:
+            get_quarantine().add(queue_id, queue_name, reason)
+        raise UnroutableQueueError(f"Can't route alerts for queue {queue_name}: {reason}")
+    
+    # A queue whose check came due and now routes leaves quarantine
+    if queue_id:
+        get_quarantine().release(queue_id)
+    
+    note = None
+    try:
+        sg = get_traced_shotgun()
+        note = sg.create(
+                   "Note",
+                   {
+                       "addressings_to": [group],
+                       "sg_status_list": "opn",
+                       "content": note_text,
+                       "subject": note_subject,
+                       "project": {"type": "Project", "id": group["sg_group_project"]["id"]}
+                       
+                   })
+    except:
+        raise
+    
+    return note
+
+
+def format_budget_alert(farm_id=None, farm_name=None, farm_hostname=None, queue_name=None, budget_id=None, budget_limit=None, default_budget_action=None, threshold=100):
+    """
+    Compose the subject and text of a budget alert.
+    
+    Returns a tuple of the alert subject and text.
+    
+    Args:
+        farm_id: Deadline Cloud farm ID
+        farm_name: Deadline Cloud farm name
+        farm_hostname: Deadline Cloud Monitor web hostname for the studio, e.g. "<farmname>.<region>.deadlinecloud.amazonaws.com"
+        queue_name: Deadline Cloud queue name
+        budget_id: Deadline Cloud budget ID
+        budget_limit: Deadline Cloud budget approximateDollarLimit
+        default_budget_action: Deadline Cloud budget defaultBudgetAction
+        threshold: alert tier reached, as a percentage of budget_limit
     """
     
     note_text = ""
     note_subject = f"Deadline Cloud Budget Alert: {queue_name} reached its limit"
-    if default_budget_action in [
+    if threshold < 100:
+        # Early warning tiers are sent before the queue's budget action applies
+        threshold_formatted = thresholds.format_threshold(threshold)
+        note_subject = f"Deadline Cloud Budget Alert: {queue_name} reached {threshold_formatted} of its limit"
+        note_text = "Deadline Budget Alert:\n"
+        note_text += f"The queue {queue_name} on farm {farm_name} has used {threshold_formatted} of its budget limit of {budget_limit}.\n"
+        note_text += "\n"
+        note_text += f"To update the budget limit on this queue: https://{farm_hostname}/farms/{farm_id}/budget/{budget_id}/edit"
+        
+    elif default_budget_action in [
         DC_BUDGET_ACTION_STOP_SCHEDULING_AND_CANCEL_TASKS,
         DC_BUDGET_ACTION_STOP_SCHEDULING_AND_COMPLETE_TASKS
     ]:
@@ -112,29 +251,64 @@ def send_budget_alert_note(farm_id=None, farm_name=None, farm_hostname=None, que
         note_text += "\n"
         note_text += f"To update the budget limit on this queue: https://{farm_hostname}/farms/{farm_id}/budget/{budget_id}/edit"
     
-    try:
-        group = get_queue_group(queue_name)
-        logger.debug(f"group: {group}")
-    except:
-        raise
+    return note_subject, note_text
+
+
+def format_alert_marker(budget_id, budget_limit, threshold):
+    """
+    Returns the idempotency marker for an alert, identifying its budget, limit and tier.
+    
+    Args:
+        budget_id: Deadline Cloud budget ID
+        budget_limit: (float) Deadline Cloud budget approximateDollarLimit
+        threshold: (float) alert tier as a percentage of budget_limit
+    """
+    
+    return f"{ALERT_MARKER_PREFIX} budget:{budget_id} limit:{float(budget_limit)!r} threshold:{float(threshold)!r}]"
+
+
+def find_alert_markers():
+    """
+    Find the idempotency markers of every alert Note sent by the notifier,
+    with one paginated bulk query.
+    
+    Returns a list of (note_id, budget_id, budget_limit, threshold) tuples, oldest Note first.
+    
+    """
+    
+    markers = []
     
-    note = None
     try:
-        sg = get_shotgun()
-        note = sg.create(
-                   "Note",
-                   {
-                       "addressings_to": [group],
-                       "sg_status_list": "opn",
-                       "content": note_text,
-                       "subject": note_subject,
-                       "project": {"type": "Project", "id": group["sg_group_project"]["id"]}
-                       
-                   })
+        sg = get_traced_shotgun()
+        page = 1
+        while True:
+            notes = sg.find(
+                "Note",
+                filters=[["content", "contains", ALERT_MARKER_PREFIX]],
+                fields=["content"],
+                order=[{"field_name": "id", "direction": "asc"}],
+                limit=NOTE_PAGE_SIZE,
+                page=page
+            )
+            
+            for note in notes:
+                match = ALERT_MARKER_PATTERN.search(note.get("content") or "")
+                if not match:
+                    continue
+                try:
+                    markers.append((note["id"], match.group(1), float(match.group(2)), float(match.group(3))))
+                except ValueError:
+                    logger.warning(f"Bad alert marker in Note {note['id']}: {match.group(0)}")
+            
+            if len(notes) < NOTE_PAGE_SIZE:
+                break
+            page += 1
     except:
         raise
     
-    return note
+    logger.debug(f"Found {len(markers)} alert markers in {page} pages of Notes")
+    
+    return markers
 
 
 def get_queue_group(queue_name):
@@ -153,8 +327,8 @@ def get_queue_group(queue_name):
     groups = get_notification_groups()
     try:
         group = [g for g in groups if queue_name in g["code"]][0]
-    except ValueError:
-        logger.error(f"No group found for queue_name: {queue_name}")
+    except IndexError:
+        logger.debug(f"No group found for queue_name: {queue_name}")
     except:
         raise
     
@@ -168,7 +342,7 @@ def create_notification_groups(queues):
     Returns a list of the Group entities created.
     
     Args:
-        queues: a list of Deadline Cloud queues
+        queues: a list of Deadline Cloud Queue records
     """
     
     groups_created = []
@@ -185,9 +359,11 @@ def create_notification_groups(queues):
         group_names = [group["code"] for group in groups]
         logger.error(f"One or more bad group names: {group_names}")
     
-    queues_needing_groups = [queue for queue in queues if queue["queueId"] not in queues_known]
+    queues_needing_groups = [queue for queue in queues if queue.queue_id not in queues_known]
     for queue in queues_needing_groups:
         group_created = create_notification_group(queue)
+        if group_created is None:
+            continue
         groups_created.append(group_created)
         logger.debug(f"Created group: {group_created['code']}")
     
@@ -204,15 +380,15 @@ def create_notification_group(queue):
     Returns the created Group entity or None if one was not created.
     
     Args:
-        queue: Deadline Cloud queue
+        queue: Deadline Cloud Queue record
     """
     
     group_created = None
     
     try:
-        sg = get_shotgun()
+        sg = get_traced_shotgun()
         
-        group_name = "{} queue:{} queue-id:{}".format(DC_NOTIFICATIONS_PREFIX, queue["displayName"], queue["queueId"])
+        group_name = "{} queue:{} queue-id:{}".format(DC_NOTIFICATIONS_PREFIX, queue.display_name, queue.queue_id)
         
         existing_group = sg.find_one("Group", filters=[["code", "contains", group_name]], fields=["code"])
         if existing_group:
@@ -224,6 +400,7 @@ def create_notification_group(queue):
     try:
         group_created = sg.create("Group", {"code": group_name})
         logger.info(f"Group created: {group_created['code']}")
+        get_group_index().add_group(group_created)
     except:
         raise
     
@@ -234,18 +411,55 @@ def get_notification_groups():
     """
     Find all notification Groups corresponding to Deadline Cloud queues.
     
+    Groups are read from the in-process group index, which only fetches Groups again
+    when ShotGrid's event log shows they changed.
+    
     Returns a list of matching Group entities or raises an exception if one occurs.
     
-    Args:
-        queue_name: Deadline Cloud queue name
     """
     
     result = None
     
     try:
-        sg = get_shotgun()
-        result = sg.find("Group", filters=[["code", "contains", DC_NOTIFICATIONS_PREFIX]], fields=["code", "sg_group_project"])
+        result = get_group_index().get_groups()
     except:
         raise
     
     return result
+
+
+def get_group_index():
+    """
+    Returns the process-wide GroupIndex of notification Groups, creating it on first use.
+    
+    """
+    
+    global _group_index
+    
+    with _group_index_lock:
+        if _group_index is None:
+            # Look up get_shotgun on each call so a replaced connection factory is used
+            _group_index = group_index.GroupIndex(
+                get_shotgun=lambda: get_traced_shotgun(),
+                code_filter=DC_NOTIFICATIONS_PREFIX,
+                fields=GROUP_FIELDS
+            )
+            # Queues are released from quarantine when an edit to their Group shows up
+            _group_index.add_listener(get_quarantine().release_groups)
+    
+    return _group_index
+
+
+def get_quarantine():
+    """
+    Returns the process-wide QueueQuarantine of queues whose alerts can't be routed, creating it on first use.
+    
+    """
+    
+    global _quarantine
+    
+    with _quarantine_lock:
+        if _quarantine is None:
+            _quarantine = quarantine.QueueQuarantine()
+    
+    return _quarantine
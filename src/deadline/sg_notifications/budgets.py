@@ -3,12 +3,22 @@ import locale
 import logging
 import logutil
 import sys
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait
 
 import alerts
 import credentials
+import cycle
+import metadata_cache
+import records
+import sinks
+import status_api
 import storage
+import thresholds
+import tracing
 
+from botocore.config import Config
 from deadline.client import api
 
 # Logging to file
@@ -26,6 +36,24 @@ log_handler.setFormatter(log_fmt)
 logger.addHandler(log_handler)
 
 
+# Worker threads scanning the farms of a studio. Each cycle gets new workers, so a scan
+# stuck in a call past the cycle deadline doesn't take a worker from later cycles.
+MAX_FARM_WORKERS = 8
+
+# Seconds before a Deadline Cloud API call gives up connecting or waiting for a response
+DEADLINE_CONNECT_TIMEOUT = 10
+DEADLINE_READ_TIMEOUT = 30
+
+# Farm IDs to the futures of their scans still running after their cycle ended. The farms
+# aren't scanned again until these return, so two scans can't alert on the same budgets.
+_stuck_scans = {}
+_stuck_scans_lock = threading.Lock()
+
+# Deadline Cloud client with timeouts, and the boto3 session it was created from
+_deadline_client = (None, None)
+_deadline_client_lock = threading.Lock()
+
+
 class DeadlineCloudHelper(object):
     """
     Deadline Cloud utility functions to get normalized output from the API
@@ -33,15 +61,19 @@ class DeadlineCloudHelper(object):
     
     """
     
-    def __init__(self, studio_hostname=None):
+    def __init__(self, studio_hostname=None, metadata_cache=None, sinks=None):
         """
         Create a DeadlineCloudHelper for the given studio hostname.
         
         Args:
             studio_hostname: Deadline Cloud studio web host name
+            metadata_cache: MetadataCache for farm and queue lists, or None to always fetch them
+            sinks: Sinks alerts are delivered to, by default only ShotGrid Notes
         """
         
         self.studio_hostname = studio_hostname
+        self.metadata_cache = metadata_cache
+        self.sinks = sinks
         self.initialize()
     
     
@@ -57,105 +89,179 @@ class DeadlineCloudHelper(object):
     
     def get_farms(self):
         """
-        Returns a list of Deadline Cloud farms for this studio.
+        Returns a list of Deadline Cloud Farm records for this studio.
         
         """
         
-        farms = None
+        if self.metadata_cache:
+            return self.metadata_cache.get_farms(self.studio_hostname, self.list_farms)
         
-        try:
-            result = api.list_farms()
-            
-            if "farms" not in result:
-                raise RuntimeError(f"No farms in result: {result.keys()}")
-            
-            farms = result["farms"]
-            
-        except:
-            raise
+        return self.list_farms()
+    
+    
+    def list_farms(self):
+        """
+        Returns a list of Deadline Cloud Farm records for this studio, bypassing the metadata cache.
         
-        return farms
+        """
+        
+        return [farm for page in self.iter_farm_pages() for farm in page]
     
     
     def get_queues(self, farm_id):
         """
-        Returns a list of Deadline Cloud queues for the given farm.
+        Returns a list of Deadline Cloud Queue records for the given farm.
         
         Args:
             farm_id: Deadline Cloud farm ID
         """
         
-        queues = None
+        if self.metadata_cache:
+            return self.metadata_cache.get_queues(farm_id, lambda: self.list_queues(farm_id))
         
-        try:
-            result = api.list_queues(farmId=farm_id)
-            
-            if "queues" not in result:
-                raise RuntimeError(f"No queues in result: {result.keys()}")
-            
-            queues = result["queues"]
+        return self.list_queues(farm_id)
+    
+    
+    def list_queues(self, farm_id):
+        """
+        Returns a list of Deadline Cloud Queue records for the given farm, bypassing the metadata cache.
         
-        except Exception as e:
-            raise e
+        Args:
+            farm_id: Deadline Cloud farm ID
+        """
+        
+        return [queue for page in self.iter_queue_pages(farm_id) for queue in page]
+    
+    
+    def get_queue(self, farm_id, queue_id):
+        """
+        Returns the Deadline Cloud Queue record with the given queue_id on a farm, or None if there isn't one.
+        
+        An unknown queue_id invalidates the farm's cached queues and fetches them again,
+        once per queue TTL.
+        
+        Args:
+            farm_id: Deadline Cloud farm ID
+            queue_id: Deadline Cloud queue ID
+        """
+        
+        for queue in self.get_queues(farm_id):
+            if queue.queue_id == queue_id:
+                return queue
+        
+        if not self.metadata_cache or self.metadata_cache.is_unknown_queue(farm_id, queue_id):
+            return None
+        
+        logger.info(f"Unknown queue {queue_id} on farm {farm_id}, refreshing its queues")
+        self.metadata_cache.invalidate_queues(farm_id)
+        for queue in self.get_queues(farm_id):
+            if queue.queue_id == queue_id:
+                return queue
+        
+        # The queue was likely deleted, so don't refresh for it again until the next queue TTL
+        self.metadata_cache.mark_unknown_queue(farm_id, queue_id)
         
-        return queues
+        return None
     
     
     def get_budgets_for_farm(self, farm_id):
         """
-        Returns a list of Deadline Cloud budgets for the given farm.
+        Returns a list of Deadline Cloud Budget records for the given farm.
         
         Args:
             farm_id: Deadline Cloud farm ID
         """
         
-        budgets = None
+        return [budget for page in self.iter_budget_pages(farm_id) for budget in page]
+    
+    
+    def iter_farm_pages(self):
+        """
+        Yields a list of Deadline Cloud Farm records for each page of deadline:ListFarms results.
         
-        try:
-            result = _list_budgets(farmId=farm_id)
-            logger.debug(f"_list_budgets: {result}")
-            
-            if "budgets" not in result:
-                raise RuntimeError(f"No budgets in result: {result.keys()}")
-            
-            budgets = result["budgets"]
-            
-        except:
-            raise
+        """
+        
+        for page in _iter_pages(_list_farms_page, "farms"):
+            yield [records.Farm.from_api(farm) for farm in page]
+    
+    
+    def iter_queue_pages(self, farm_id):
+        """
+        Yields a list of Deadline Cloud Queue records for each page of deadline:ListQueues results.
         
-        return budgets
+        Args:
+            farm_id: Deadline Cloud farm ID
+        """
+        
+        for page in _iter_pages(_list_queues_page, "queues", farmId=farm_id):
+            yield [records.Queue.from_api(queue, farm_id=farm_id) for queue in page]
+    
+    
+    def iter_budget_pages(self, farm_id, deadline=None):
+        """
+        Yields a list of Deadline Cloud Budget records for each page of deadline:ListBudgets results.
+        
+        Args:
+            farm_id: Deadline Cloud farm ID
+            deadline: CycleDeadline after which no more pages are waited for, if any
+        """
+        
+        for page in _iter_pages(_list_budgets_page, "budgets", deadline=deadline, farmId=farm_id):
+            budgets = [records.Budget.from_api(budget) for budget in page]
+            logger.debug(f"_list_budgets_page: {len(budgets)} budgets")
+            yield budgets
     
     
     def get_farm_from_queue_id(self, queue_id):
         """
-        Returns the Deadline Cloud farm that contains a queue with the given queue_id.
+        Returns the Deadline Cloud Farm record that contains a queue with the given queue_id.
+        
+        If no cached farm has the queue, the studio's cached farms are invalidated and fetched again,
+        once per queue TTL, in case the queue is on a new farm.
         
         Args:
             queue_id: Deadline Cloud queue ID
         """
         
+        farm_result = self._find_farm_from_queue_id(queue_id)
+        if farm_result is not None:
+            return farm_result
+        
+        if not self.metadata_cache or self.metadata_cache.is_unknown_queue(self.studio_hostname, queue_id):
+            return None
+        
+        logger.info(f"Unknown queue {queue_id} on studio {self.studio_hostname}, refreshing its farms")
+        self.metadata_cache.invalidate_farms(self.studio_hostname)
+        farm_result = self._find_farm_from_queue_id(queue_id)
+        if farm_result is None:
+            self.metadata_cache.mark_unknown_queue(self.studio_hostname, queue_id)
+        
+        return farm_result
+    
+    
+    def _find_farm_from_queue_id(self, queue_id):
         farm_result = None
         
-        farm_id = None
+        farms = []
         try:
             farms = self.get_farms()
         except Exception as e:
             if e.__class__.__name__ == "AccessDeniedException":
-                logger.error(f"Access denied for ListQueues on farm: {farm['farmId']}")
+                logger.error(f"Access denied for ListFarms on studio: {self.studio_hostname}")
                 logger.error(sys.exc_info())
             else:
                 raise
         
-        logger.debug(f"farms: {farms}")
+        logger.debug(f"farms: {len(farms)}")
         for farm in farms:
             try:
-                for queue in self.get_queues(farm["farmId"]):
-                    if queue["queueId"] == queue_id:
+                for queue in self.get_queues(farm.farm_id):
+                    if queue.queue_id == queue_id:
                         farm_result = farm
                         break
             except Exception as e:
                 if e.__class__.__name__ == "AccessDeniedException":
-                    logger.error(f"Access denied for ListQueues on farm: {farm['farmId']}")
+                    logger.error(f"Access denied for ListQueues on farm: {farm.farm_id}")
                     logger.error(sys.exc_info())
                 else:
                     raise
@@ -163,158 +269,340 @@ class DeadlineCloudHelper(object):
         return farm_result
     
     
-    def notify_queue_over_limit(self, budgets_to_notify):
+    def notify_queue_over_limit(self, budgets_to_notify, farm=None, deadline=None):
         """
         Send budget alert notifications to users monitoring the budgeted queues.
         
-        Returns a list of Deadline Cloud budgets which had alert notifications sent.
+        Every alert is delivered to every sink in parallel.
+        
+        Returns a list of Breach records which had alert notifications sent.
         
         Args:
-            budgets_to_notify: Deadline Cloud budgets for which notifications will be sent.
+            budgets_to_notify: Breach records for which notifications will be sent.
+            farm: Farm record the budgets belong to, if known, to skip looking it up
+            deadline: CycleDeadline that deliveries must finish by, if any
         """
         
         notified_over_limit = []
         
-        for budget in budgets_to_notify:
-            budget_id = budget["budgetId"]
-            budget_limit = budget["approximateDollarLimit"]
+        # Read the alert ledger once for the whole page of breaches
+        alert_data = get_alert_data()
+        
+        breaches_to_send = []
+        alerts_to_send = []
+        for breach in budgets_to_notify:
+            budget = breach.budget
+            budget_id = budget.budget_id
+            budget_limit = budget.approximate_dollar_limit
+            threshold = breach.threshold
             
-            queue_id = budget["usageTrackingResource"]["queueId"]
+            queue_id = budget.queue_id
+            budget_farm = farm
             try:
-                farm = self.get_farm_from_queue_id(queue_id)
-                farm_name = farm["displayName"]
+                if budget_farm is None:
+                    budget_farm = self.get_farm_from_queue_id(queue_id)
+                farm_name = budget_farm.display_name
                 logger.debug(f"Farm: {farm_name}  Budget: {budget_id}")
+                
+                queue = self.get_queue(budget_farm.farm_id, queue_id)
             except:
                 logger.error(sys.exc_info())
                 continue
             
-            queue_name = None
-            default_budget_action = None
-            for queue in self.get_queues(farm["farmId"]):
-                if queue["queueId"] == queue_id:
-                    queue_name = queue["displayName"]
-                    default_budget_action = queue["defaultBudgetAction"]
+            if queue is None:
+                logger.error(f"Queue {queue_id} for budget {budget_id} not found on farm: {budget_farm.farm_id}")
+                continue
+            
+            queue_name = queue.display_name
+            default_budget_action = queue.default_budget_action
             
-            # Check if an alert for this budget limit has already been sent
+            # Check if an alert for this budget limit and tier has already been sent
             try:
-                if get_alert_sent(budget_id, budget_limit):
-                    logger.debug(f"Skipping notification for budget: {budget_id}  limit: {budget_limit}")
+                if get_alert_sent(budget_id, budget_limit, threshold, alert_data=alert_data):
+                    logger.debug(f"Skipping notification for budget: {budget_id}  limit: {budget_limit}  threshold: {threshold}")
                     continue
             except:
                 logger.error(traceback.format_exc())
                 # continue
             
-            # Budgets in Deadline Cloud are always USD
-            # Apply dollar symbol to budget limit with commas as thousands separators
-            budget_limit_formatted = "${:0,.2f}".format(budget["approximateDollarLimit"])
+            breaches_to_send.append(breach)
+            alerts_to_send.append(sinks.Alert(
+                farm_id=budget_farm.farm_id,
+                farm_name=farm_name,
+                farm_hostname=self.studio_hostname,
+                queue_id=queue_id,
+                queue_name=queue_name,
+                budget_id=budget_id,
+                budget_limit=budget_limit,
+                default_budget_action=default_budget_action,
+                threshold=threshold
+            ))
+        
+        if not alerts_to_send:
+            return notified_over_limit
+        
+        # Don't start deliveries the cycle has no time left to wait for
+        if deadline:
+            deadline.check()
+        
+        # Send the alerts to the users monitoring these queues
+        results = sinks.deliver(
+            alerts_to_send,
+            self.sinks or [sinks.ShotGridNoteSink()],
+            deadline=deadline,
+            on_late_delivery=lambda alert: set_alert_sent(alert.budget_id, alert.budget_limit, alert.threshold)
+        )
+        
+        for breach, delivered in zip(breaches_to_send, results):
+            logger.debug(f"Delivered budget {breach.budget.budget_id}: {delivered}")
             
-            # Send an alert to the users monitoring this queue
-            try:
-                note = alerts.send_budget_alert_note(
-                    farm_id=farm["farmId"],
-                    farm_name=farm_name,
-                    farm_hostname=self.studio_hostname,
-                    queue_name=queue_name,
-                    budget_id=budget_id,
-                    budget_limit=budget_limit_formatted,
-                    default_budget_action=default_budget_action
-                )
-                logger.debug(f"Sent note: {note}")
-                
-                alert_sent = set_alert_sent(budget_id, budget_limit)
-                logger.debug(f"alert_sent: {alert_sent}")
-                
-                notified_over_limit.append(budget)
-            except:
-                logger.error(sys.exc_info())
-                continue
+            # Record the alert as sent once any sink delivered it, so working sinks don't repeat it
+            if any(delivered.values()):
+                notified_over_limit.append(breach)
+        
+        # Write every sent alert to the ledger at once
+        if notified_over_limit:
+            alerts_sent = set_alerts_sent([
+                (breach.budget.budget_id, breach.budget.approximate_dollar_limit, breach.threshold)
+                for breach in notified_over_limit
+            ])
+            logger.debug(f"alerts_sent: {alerts_sent}")
         
         return notified_over_limit
     
     
-def get_budgets_to_notify(budgets):
+def get_budgets_to_notify(budgets, engine=None):
     """
-    Find budgets which are marked ACTIVE and have usage that has met or exceeded the limit.
+    Find budgets which are marked ACTIVE and have usage that has met or exceeded one of their alert tiers.
     
-    Returns a list of Deadline Cloud budgets matching those criteria.
+    Returns a list of Breach records holding each matching budget and the highest tier it reached.
     
     Args:
-        budgets: a list of Deadline Cloud budgets
+        budgets: a list of Deadline Cloud Budget records
+        engine: ThresholdEngine holding the alert tiers, by default only the budget limit
     """
     
-    budgets_to_notify = []
-    
-    for budget in budgets:
-        # logger.debug(f"budget: {budget}")
-        budget_id = budget['budgetId']
-        # logger.debug(f"budgetId: {budget_id}")
-        
-        queue_id = budget["usageTrackingResource"]["queueId"]
-        # logger.debug(f"queue_id: {queue_id}")
-        
-        # Budgets are ACTIVE or INACTIVE
-        status = budget["status"]
-        if status != "ACTIVE":
-            logger.debug(f"Skipping budget with status: {status}")
-            continue
-        
-        usage_over_limit = budget["usages"]["approximateDollarUsage"] >= budget["approximateDollarLimit"]
-        if usage_over_limit:
-            budgets_to_notify.append(budget)
+    engine = engine or thresholds.ThresholdEngine()
     
-    return budgets_to_notify
+    return engine.evaluate(budgets)
 
 
-def check_budgets_and_notify(studio_hostname):
+def check_budgets_and_notify(studio_hostname, deadline=None):
     """
     Check all budgets in this Deadline Cloud studio and send notifications
-    for any that are over their usage limit.
+    for any that have reached one of their alert tiers.
     
-    Returns a dict with a list of Deadline Cloud budgets which need notifications sent.
+    Farms are scanned in parallel, starting with farms left incomplete by the previous cycle.
+    Farms whose scans don't finish before the deadline are recorded as incomplete.
+    
+    Returns a dict with a list of Deadline Cloud budgets which need notifications sent,
+    and the IDs of any incomplete farms.
     
     Args:
         studio_hostname: Deadline Cloud studio web host name
+        deadline: CycleDeadline the farm scans must finish by, if any
     """
     
+    with tracing.span("budgets.check_budgets_and_notify", studio_hostname=studio_hostname) as span:
+        result = _check_budgets_and_notify(studio_hostname, deadline=deadline)
+        span.set_attributes(
+            notified_count=len(result.get("notified_over_limit", [])),
+            incomplete_farm_count=len(result.get("incomplete_farms", []))
+        )
+    
+    return result
+
+
+def _check_budgets_and_notify(studio_hostname, deadline=None):
     result = {}
     
     logger.debug(f"studio_hostname: {studio_hostname}")
     
+    if deadline is None:
+        deadline = cycle.CycleDeadline()
+    
     # Get a DeadlineCloudHelper for this studio
     try:
-        dch = DeadlineCloudHelper(studio_hostname=studio_hostname)
+        dch = DeadlineCloudHelper(
+            studio_hostname=studio_hostname,
+            metadata_cache=metadata_cache.get_default_cache(),
+            sinks=sinks.get_sinks()
+        )
+        engine = thresholds.ThresholdEngine.from_config()
     except:
         raise
     
-    # Check every farm in the studio
-    for farm in dch.get_farms():
-        logger.debug(f"farm: {farm['farmId']}")
+    executor = ThreadPoolExecutor(max_workers=MAX_FARM_WORKERS, thread_name_prefix="farm_scan")
+    try:
+        # Listing the farms counts against the deadline like the scans
         try:
-            budgets = dch.get_budgets_for_farm(farm_id=farm["farmId"])
-        except:
-            raise
-        # logger.debug(f"Received {len(budgets)}: {budgets}")
-        
-        # Check if any budgets are over limit
-        budgets_to_notify = get_budgets_to_notify(budgets)
-        logger.debug(f"budgets_to_notify: {budgets_to_notify}")
-        
-        # Check if any ShotGrid groups need creation
-        groups_created = alerts.create_notification_groups(dch.get_queues(farm["farmId"]))
-        if groups_created:
-            logger.info(f"groups_created: {groups_created}")
+            farms = executor.submit(tracing.wrap(dch.get_farms)).result(timeout=deadline.remaining())
+        except TimeoutError:
+            logger.warning(f"Couldn't list the farms of studio {studio_hostname} before the cycle deadline")
+            result["farms_listed"] = False
+            return result
+        
+        # Check every farm in the studio, farms left incomplete last cycle first
+        farms = cycle.prioritize_farms(farms, cycle.get_incomplete_farms(studio_hostname))
+        
+        # Stop serving the status of farms that were deleted
+        snapshot = status_api.get_snapshot()
+        if snapshot:
+            snapshot.remove_missing_farms(studio_hostname, [farm.farm_id for farm in farms])
+        
+        # Farms whose scan from an earlier cycle is still running are left to that scan
+        stuck_farm_ids = _get_stuck_farm_ids()
+        skipped_farms = [farm for farm in farms if farm.farm_id in stuck_farm_ids]
+        farms = [farm for farm in farms if farm.farm_id not in stuck_farm_ids]
+        
+        futures = {executor.submit(tracing.wrap(check_farm_budgets), dch, farm, engine, deadline): farm for farm in farms}
+        
+        done, not_done = wait(futures, timeout=deadline.remaining())
+    finally:
+        # Don't wait for workers stuck in a call past the deadline, they're tracked until they return
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    _add_stuck_scans({future: farm for future, farm in futures.items() if future in not_done})
+    
+    incomplete_farms = []
+    for farm in skipped_farms:
+        logger.warning(f"Skipped farm {farm.farm_id}, its scan from an earlier cycle is still running")
+        incomplete_farms.append(farm.farm_id)
+    
+    for future, farm in futures.items():
+        if future in not_done:
+            # Scans that haven't started are dropped, running scans stop at their next deadline check
+            logger.warning(f"Scan of farm {farm.farm_id} didn't finish before the cycle deadline")
+            incomplete_farms.append(farm.farm_id)
+            continue
         
-        # If any notifications are needed
-        if budgets_to_notify:
-            try:
-                # Send budget notifications to the groups corresponding to queues who are over budget
-                result["notified_over_limit"] = dch.notify_queue_over_limit(budgets_to_notify)
-            except:
-                raise
+        try:
+            notified = future.result()
+        except cycle.CycleDeadlineExceeded:
+            logger.warning(f"Scan of farm {farm.farm_id} didn't finish before the cycle deadline")
+            incomplete_farms.append(farm.farm_id)
+            continue
+        except:
+            logger.error(f"Couldn't check budgets on farm: {farm.farm_id}")
+            logger.error(traceback.format_exc())
+            incomplete_farms.append(farm.farm_id)
+            continue
         
+        if notified:
+            result.setdefault("notified_over_limit", []).extend(notified)
+    
+    if incomplete_farms:
+        result["incomplete_farms"] = incomplete_farms
+    cycle.set_incomplete_farms(studio_hostname, incomplete_farms)
+    
     return result
 
 
+def _get_stuck_farm_ids():
+    """
+    Returns a set of the IDs of farms whose scans from earlier cycles are still running, e.g. stuck in a call,
+    logging their count.
+    
+    """
+    
+    with _stuck_scans_lock:
+        # Scans that returned since the last check are no longer stuck
+        for farm_id in [farm_id for farm_id, future in _stuck_scans.items() if future.done()]:
+            del _stuck_scans[farm_id]
+        stuck_farm_ids = set(_stuck_scans)
+    
+    if stuck_farm_ids:
+        logger.warning(f"stuck_farm_scans={len(stuck_farm_ids)}: scans from earlier cycles are still waiting on a call")
+    
+    return stuck_farm_ids
+
+
+def _add_stuck_scans(not_done):
+    """
+    Track the scans still running after the cycle deadline until they return.
+    
+    Args:
+        not_done: dict of the futures of this cycle's unfinished scans to their Farm records
+    """
+    
+    with _stuck_scans_lock:
+        for future, farm in not_done.items():
+            if future.running():
+                _stuck_scans[farm.farm_id] = future
+
+
+def check_farm_budgets(dch, farm, engine, deadline=None):
+    """
+    Check all budgets on a farm and send notifications for any that have reached one of their alert tiers.
+    
+    Raises CycleDeadlineExceeded if the deadline passes before the scan finishes.
+    
+    Returns a list of Breach records which had alert notifications sent.
+    
+    Args:
+        dch: DeadlineCloudHelper for the farm's studio
+        farm: Farm record to check
+        engine: ThresholdEngine the budgets are evaluated with
+        deadline: CycleDeadline the scan must finish by, if any
+    """
+    
+    with tracing.span("budgets.check_farm_budgets", farm_id=farm.farm_id) as span:
+        return _check_farm_budgets(dch, farm, engine, deadline, span)
+
+
+def _check_farm_budgets(dch, farm, engine, deadline, span):
+    notified_over_limit = []
+    page_count = 0
+    budget_count = 0
+    breach_count = 0
+    
+    logger.debug(f"farm: {farm.farm_id}")
+    
+    queues = dch.get_queues(farm.farm_id)
+    
+    # Check if any ShotGrid groups need creation
+    groups_created = alerts.create_notification_groups(queues)
+    if groups_created:
+        logger.info(f"groups_created: {groups_created}")
+    span.set_attributes(queue_count=len(queues), groups_created=len(groups_created))
+    
+    # Keep the farm's budgets for the status API snapshot, if it's being served
+    snapshot = status_api.get_snapshot()
+    farm_budgets = []
+    farm_breaches = []
+    
+    # Evaluate each page of budgets as it arrives, and send its notifications before the next page
+    try:
+        for budgets in dch.iter_budget_pages(farm_id=farm.farm_id, deadline=deadline):
+            # Check if any budgets are over limit
+            budgets_to_notify = get_budgets_to_notify(budgets, engine=engine)
+            logger.debug(f"budgets_to_notify: {[breach.budget.budget_id for breach in budgets_to_notify]}")
+            
+            page_count += 1
+            budget_count += len(budgets)
+            breach_count += len(budgets_to_notify)
+            span.set_attributes(page_count=page_count, budget_count=budget_count, breach_count=breach_count)
+            
+            if snapshot:
+                farm_budgets.extend(budgets)
+                farm_breaches.extend(budgets_to_notify)
+            
+            # If any notifications are needed
+            if budgets_to_notify:
+                # Send budget notifications to the groups corresponding to queues who are over budget
+                notified = dch.notify_queue_over_limit(budgets_to_notify, farm=farm, deadline=deadline)
+                notified_over_limit.extend(notified)
+    except:
+        raise
+    
+    if snapshot:
+        snapshot.update_farm(dch.studio_hostname, farm, queues, farm_budgets, farm_breaches)
+    
+    span.set_attribute("notified_count", len(notified_over_limit))
+    
+    return notified_over_limit
+
+
 def get_studio_hostnames():
     """
     Get a list of studio hostnames from the credentials store.
@@ -334,88 +622,325 @@ def get_studio_hostnames():
     return studio_hostnames
 
 
-def get_alert_sent(budget_id, budget_limit):
+def get_alert_data():
+    """
+    Returns the stored alert ledger, or an empty dict if it can't be read.
+    
+    """
+    
+    alert_data = {}
+    try:
+        alert_data = storage.get_stored_data()
+    except Exception as e:
+        logger.error("Couldn't read stored data")
+        logger.error(traceback.format_exc())
+    
+    return alert_data
+
+
+def get_alert_sent(budget_id, budget_limit, threshold=100, alert_data=None):
     """
     Get if a budget alert notification was sent the given budgeted queue.
     
     Returns None if no data is available, or boolean if a matching budget alert was already sent.
+    An alert sent for a higher tier of the same budget limit also counts as sent.
     
     Args:
         budget_id: Deadline Cloud budget ID
         budget_limit: (float) Deadline Cloud budget approximateDollarLimit
+        threshold: (float) alert tier as a percentage of budget_limit
+        alert_data: alert ledger from get_alert_data, to avoid reading it for every budget
     """
     
     alert_sent = None
     
-    alert_data = {}
-    try:
-        alert_data = storage.get_stored_data()
-    except Exception as e:
-        logger.error("Couldn't read stored data")
-        logger.error(traceback.format_exc())
+    if alert_data is None:
+        alert_data = get_alert_data()
     
     if not alert_data:
         return None
     
     if budget_id in alert_data:
         if alert_data[budget_id]["approximateDollarLimit"] == budget_limit:
-            # An alert was previously sent for this budget's budget_limit
-            alert_sent = True
+            # An alert was previously sent for this budget's budget_limit at this tier or higher
+            alert_sent = max(_get_thresholds_sent(alert_data[budget_id])) >= threshold
     
     return alert_sent
 
 
-def set_alert_sent(budget_id, budget_limit):
+def set_alert_sent(budget_id, budget_limit, threshold=100):
     """
-    Stores a budget_limit for a budget_id.
+    Stores a budget_limit and the alert tiers sent for a budget_id.
     
     Args:
         budget_id: Deadline Cloud budget ID
         budget_limit: (float) Deadline Cloud budget approximateDollarLimit
+        threshold: (float) alert tier as a percentage of budget_limit
+    """
+    
+    return set_alerts_sent([(budget_id, budget_limit, threshold)])
+
+
+def set_alerts_sent(alerts_sent):
     """
+    Stores the budget_limit and alert tiers sent for several budgets with a single ledger update.
     
-    alert_stored = None
+    The tiers are merged with the stored entries while other ledger updates wait, so a concurrent
+    update for the same budget, e.g. from a late delivery, can't lose a tier.
     
-    alert_data = {}
-    try:
-        alert_data = storage.get_stored_data()
-    except Exception as e:
-        logger.error("Couldn't read stored data")
-        logger.error(traceback.format_exc())
+    Returns a dict of the stored ledger entries.
     
-    alert_to_store = {budget_id: {"approximateDollarLimit": budget_limit}}
-    # logger.debug(alert_to_store)
+    Args:
+        alerts_sent: a list of (budget_id, budget_limit, threshold) tuples
+    """
+    
+    alerts_to_store = {}
+    
+    def merge(alert_data):
+        alerts_to_store.clear()
+        for budget_id, budget_limit, threshold in alerts_sent:
+            # Tiers sent for a previous budget limit don't apply to a new limit
+            alert_entry = alerts_to_store.get(budget_id) or alert_data.get(budget_id)
+            thresholds_sent = []
+            if alert_entry and alert_entry.get("approximateDollarLimit") == budget_limit:
+                thresholds_sent = _get_thresholds_sent(alert_entry)
+            thresholds_sent = sorted(set(thresholds_sent) | {threshold})
+            
+            alerts_to_store[budget_id] = {"approximateDollarLimit": budget_limit, "thresholds": thresholds_sent}
+        
+        return alerts_to_store
     
     try:
-        data_written = storage.update_stored_data(alert_to_store)
+        storage.merge_stored_data(merge)
     except:
         logger.error("Couldn't write stored data")
         logger.error(traceback.format_exc())
     
-    return alert_to_store
+    return alerts_to_store
+
+
+def _get_thresholds_sent(alert_entry):
+    """
+    Returns the alert tiers sent for a stored budget entry.
+    
+    Entries stored before alert tiers were supported only ever alerted at the budget limit.
+    
+    Args:
+        alert_entry: stored alert data for a budget
+    """
+    
+    return alert_entry.get("thresholds", [100])
+
+
+def recover_alert_ledger(force=False):
+    """
+    Rebuild the alert ledger from the idempotency markers on alert Notes in ShotGrid
+    if it's missing, empty or unreadable, so a lost ledger doesn't re-send every alert.
+    
+    Returns the number of budgets recovered, or None if the ledger didn't need recovery.
+    
+    Args:
+        force: rebuild the ledger even if it's readable
+    """
+    
+    if not force:
+        alert_data = {}
+        try:
+            alert_data = storage.get_stored_data()
+        except FileNotFoundError:
+            logger.warning("No stored data found")
+        except:
+            logger.error("Couldn't read stored data")
+            logger.error(traceback.format_exc())
+        
+        if alert_data:
+            return None
+    
+    logger.info("Rebuilding the alert ledger from ShotGrid Notes")
+    
+    try:
+        markers = alerts.find_alert_markers()
+    except:
+        raise
+    
+    # The latest Note for a budget holds its current limit, and tiers sent for older limits don't apply
+    recovered = {}
+    for note_id, budget_id, budget_limit, threshold in markers:
+        entry = recovered.get(budget_id)
+        if entry is None or entry["approximateDollarLimit"] != budget_limit:
+            entry = {"approximateDollarLimit": budget_limit, "thresholds": []}
+            recovered[budget_id] = entry
+        if threshold not in entry["thresholds"]:
+            entry["thresholds"] = sorted(entry["thresholds"] + [threshold])
+    
+    if recovered:
+        try:
+            storage.update_stored_data(recovered)
+        except:
+            logger.error("Couldn't write stored data")
+            logger.error(traceback.format_exc())
+    
+    logger.info(f"Recovered alert ledger entries for {len(recovered)} budgets from {len(markers)} Notes")
+    
+    return len(recovered)
+
+
+def _iter_pages(list_page, key, deadline=None, **kwargs):
+    """
+    Yields the items in each page of a paginated Deadline Cloud list API call as it arrives.
+    
+    The next page is requested in the background while the caller processes the current one.
+    
+    Args:
+        list_page: function calling the API for a single page
+        key: name of the list of items in each response
+        deadline: CycleDeadline after which CycleDeadlineExceeded is raised instead of waiting for a page
+    
+    kwargs:
+        Arguments for the API call
+    """
+    
+    def get_page(page_number, **page_kwargs):
+        with tracing.span(f"deadline.list_{key}", page=page_number, farm_id=kwargs.get("farmId")) as span:
+            result = list_page(**page_kwargs)
+            span.set_attribute("item_count", len(result.get(key, [])))
+            return result
+    
+    page_number = 0
+    
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"list_{key}")
+    try:
+        future = executor.submit(tracing.wrap(get_page), page_number, **kwargs)
+        while future:
+            if deadline:
+                deadline.check()
+            
+            try:
+                result = future.result(timeout=deadline.remaining() if deadline else None)
+            except TimeoutError:
+                raise cycle.CycleDeadlineExceeded(f"Cycle deadline passed waiting for a page of {key}")
+            
+            if key not in result:
+                raise RuntimeError(f"No {key} in result: {result.keys()}")
+            
+            future = None
+            if result.get("nextToken"):
+                page_number += 1
+                future = executor.submit(tracing.wrap(get_page), page_number, nextToken=result["nextToken"], **kwargs)
+            
+            page = result[key]
+            
+            # Release the response page before the caller processes it
+            del result
+            
+            yield page
+    finally:
+        # Don't wait for a page request that's stuck past the deadline
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _get_principal_kwargs(kwargs):
+    """
+    Returns kwargs with the principalId of the Deadline Cloud Monitor user added,
+    matching the Deadline Cloud client's list_farms and list_queues.
+    
+    Args:
+        kwargs: Arguments for the API call
+    """
+    
+    if "principalId" not in kwargs:
+        user_id, _ = api.get_user_and_identity_store_id()
+        if user_id:
+            kwargs = dict(kwargs, principalId=str(user_id))
+    
+    return kwargs
+
+
+def _get_deadline_client():
+    """
+    Returns a deadline boto3 client like the Deadline Cloud client's, with connect and read timeouts
+    so a call can't hang a farm scan. It's reused until the Deadline Cloud client's session changes.
+    
+    """
+    
+    global _deadline_client
+    
+    session = api._session.get_boto3_session()
+    with _deadline_client_lock:
+        if _deadline_client[0] is not session:
+            client = api._session.get_boto3_client("deadline")
+            timeouts = Config(connect_timeout=DEADLINE_CONNECT_TIMEOUT, read_timeout=DEADLINE_READ_TIMEOUT)
+            _deadline_client = (session, session.client(
+                "deadline",
+                endpoint_url=client.meta.endpoint_url,
+                region_name=client.meta.region_name,
+                config=client.meta.config.merge(timeouts)
+            ))
+        return _deadline_client[1]
+
+
+def _list_farms_page(*args, **kwargs):
+    """
+    Calls the deadline:ListFarms API call for a single page of farms.
+    
+    kwargs:
+        nextToken: pagination token from the previous page
+    """
+    
+    return _get_deadline_client().list_farms(*args, **_get_principal_kwargs(kwargs))
+
+
+def _list_queues_page(*args, **kwargs):
+    """
+    Calls the deadline:ListQueues API call for a single page of queues.
+    
+    kwargs:
+        farmId: Deadline Cloud farm ID
+        nextToken: pagination token from the previous page
+    """
+    
+    return _get_deadline_client().list_queues(*args, **_get_principal_kwargs(kwargs))
 
 
-def _list_budgets(*args, **kwargs):
+def _list_budgets_page(*args, **kwargs):
     """
-    Calls the deadline:ListBudgets API call. If the response is paginated,
-    it repeatedly calls the API to get all the budgets.
+    Calls the deadline:ListBudgets API call for a single page of budgets.
     
     kwargs:
         farmId: Deadline Cloud farm ID
+        nextToken: pagination token from the previous page
     """
     
-    deadline_client = api._session.get_boto3_client("deadline")
-    return api._list_apis._call_paginated_deadline_list_api(deadline_client.list_budgets, "budgets", **kwargs)
+    return _get_deadline_client().list_budgets(*args, **kwargs)
 
 
-def run():
+def run(cycle_deadline=None):
+    """
+    Check the budgets of every studio in parallel, under one deadline for the whole cycle.
+    
+    Returns a list with the result of each studio.
+    
+    Args:
+        cycle_deadline: seconds the cycle may run, overriding the configuration file
+    """
+    
     results = []
     
-    studio_hostnames = get_studio_hostnames()
-    for studio_hostname in studio_hostnames:
-        result = check_budgets_and_notify(studio_hostname)
-        results.append(result)
-        logger.debug(f"result: {result}")
+    deadline = cycle.CycleDeadline.from_config(cycle_deadline)
+    
+    # Each sampled cycle is recorded as one trace
+    with tracing.span("budgets.run", root=True, cycle_deadline=deadline.seconds) as span:
+        studio_hostnames = get_studio_hostnames()
+        span.set_attribute("studio_count", len(studio_hostnames))
+        
+        with ThreadPoolExecutor(max_workers=max(1, len(studio_hostnames)), thread_name_prefix="studio") as executor:
+            futures = [executor.submit(tracing.wrap(check_budgets_and_notify), studio_hostname, deadline) for studio_hostname in studio_hostnames]
+            for future in futures:
+                result = future.result()
+                results.append(result)
+                logger.debug(f"result: {result}")
+        
+        # Summarize the queues whose alerts couldn't be routed once per cycle
+        span.set_attribute("unroutable_queue_count", alerts.get_quarantine().report())
     
     return results
-
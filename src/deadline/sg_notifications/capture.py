@@ -0,0 +1,396 @@
+import datetime
+import gzip
+import json
+import logging
+import logutil
+import os
+import tempfile
+import threading
+import time
+import traceback
+
+import alerts
+import budgets
+import cycle
+import group_index
+import metadata_cache
+import sinks
+import storage
+
+# Logging to file
+logutil.add_file_handler()
+logger = logging.getLogger(__name__)
+logger.setLevel(logutil.get_deadline_config_level())
+
+# Logging to stdout
+log_handler = logging.StreamHandler()
+log_fmt = logging.Formatter(
+    "%(asctime)s - [%(levelname)-7s] "
+    "[%(module)s:%(funcName)s:%(lineno)d] %(message)s"
+)
+log_handler.setFormatter(log_fmt)
+logger.addHandler(log_handler)
+
+
+CAPTURE_VERSION = 2
+REDACTED = "<redacted>"
+
+# Any dict key containing one of these fragments has its value redacted
+SECRET_KEY_FRAGMENTS = ("password", "api_key", "apikey", "secret", "token", "session", "credential")
+
+# Keys matching a secret fragment that are safe to keep, such as pagination tokens
+ALLOWED_KEYS = ("nextToken",)
+
+# Keys carrying only transport details that the notifier never reads
+DROPPED_KEYS = ("ResponseMetadata",)
+
+# Deadline Cloud list calls made by the notifier, one per page, as attribute names on the budgets module
+DEADLINE_CALLS = ("_list_farms_page", "_list_queues_page", "_list_budgets_page")
+
+# ShotGrid calls made by the notifier on a Shotgun connection
+SHOTGRID_CALLS = ("find", "find_one", "create", "update", "summarize")
+
+
+class CaptureError(Exception):
+    """Raised when a replayed call has no matching recorded response."""
+
+
+def redact(value):
+    """
+    Returns a copy of value with secrets redacted and values made JSON friendly.
+    
+    Args:
+        value: a response or argument value from a Deadline Cloud or ShotGrid call
+    """
+    
+    if isinstance(value, dict):
+        result = {}
+        for key, item in value.items():
+            if key in DROPPED_KEYS:
+                continue
+            if key not in ALLOWED_KEYS and any(fragment in str(key).lower() for fragment in SECRET_KEY_FRAGMENTS):
+                result[key] = REDACTED
+            else:
+                result[key] = redact(item)
+        return result
+    
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    
+    return str(value)
+
+
+def call_key(service, method, args, kwargs):
+    """
+    Returns a string identifying a call by service, method and redacted arguments.
+    
+    Args:
+        service: "deadline" or "shotgrid"
+        method: name of the API call
+        args: positional arguments of the call
+        kwargs: keyword arguments of the call
+    """
+    
+    return json.dumps([service, method, redact(list(args)), redact(kwargs)], sort_keys=True)
+
+
+class Recorder(object):
+    """
+    Captures every Deadline Cloud list call and ShotGrid call the notifier makes,
+    with responses and timings, into a gzipped JSON lines capture file.
+    
+    """
+    
+    def __init__(self, path):
+        """
+        Create a Recorder writing to the given capture file.
+        
+        Args:
+            path: path of the capture file to write
+        """
+        
+        self.path = path
+        self.started = None
+        self.lock = threading.Lock()
+        self.originals = {}
+        self.temp_dir = None
+        self.file = gzip.open(path, "wt", encoding="utf-8")
+    
+    
+    def _write(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record, separators=(",", ":")) + "\n")
+    
+    
+    def wrap(self, service, method, func):
+        """
+        Returns a callable that invokes func and records its response and timing.
+        
+        Args:
+            service: "deadline" or "shotgrid"
+            method: name of the API call
+            func: the callable to record
+        """
+        
+        def recorded(*args, **kwargs):
+            start = time.monotonic()
+            record = {
+                "service": service,
+                "method": method,
+                "args": redact(list(args)),
+                "kwargs": redact(kwargs),
+                "offset": round(start - self.started, 6),
+            }
+            try:
+                response = func(*args, **kwargs)
+            except Exception as e:
+                record["duration"] = round(time.monotonic() - start, 6)
+                record["error"] = {"type": e.__class__.__name__, "message": str(e)}
+                self._write(record)
+                raise
+            
+            record["duration"] = round(time.monotonic() - start, 6)
+            record["response"] = redact(response)
+            self._write(record)
+            
+            return response
+        
+        return recorded
+    
+    
+    def install(self):
+        """
+        Patch the notifier's Deadline Cloud and ShotGrid entry points to record calls.
+        
+        The alert ledger is saved in the capture header, so a replay skips the same alerts.
+        Call offsets are measured from here.
+        
+        """
+        
+        self.started = time.monotonic()
+        self._write({
+            "capture_version": CAPTURE_VERSION,
+            "created": datetime.datetime.now().isoformat(),
+            "ledger": _read_ledger()
+        })
+        
+        for name in DEADLINE_CALLS:
+            self.originals[(budgets, name)] = getattr(budgets, name)
+            setattr(budgets, name, self.wrap("deadline", name, getattr(budgets, name)))
+        
+        get_shotgun = alerts.get_shotgun
+        self.originals[(alerts, "get_shotgun")] = get_shotgun
+        
+        def recorded_get_shotgun(*args, **kwargs):
+            sg = get_shotgun(*args, **kwargs)
+            if sg is None:
+                return None
+            return _ShotgunProxy({method: self.wrap("shotgrid", method, getattr(sg, method)) for method in SHOTGRID_CALLS})
+        
+        alerts.get_shotgun = recorded_get_shotgun
+        
+        self.temp_dir = tempfile.TemporaryDirectory(prefix="sg_notifications_record_")
+        _use_cold_caches(self.originals, self.temp_dir.name)
+        
+        logger.info(f"Recording Deadline Cloud and ShotGrid calls to: {self.path}")
+    
+    
+    def uninstall(self):
+        """
+        Restore the patched entry points and close the capture file.
+        
+        """
+        
+        for (module, name), original in self.originals.items():
+            setattr(module, name, original)
+        self.originals = {}
+        
+        if self.temp_dir:
+            self.temp_dir.cleanup()
+            self.temp_dir = None
+        
+        with self.lock:
+            self.file.close()
+
+
+class Replayer(object):
+    """
+    Serves recorded responses from a capture file in place of live Deadline Cloud
+    and ShotGrid calls so budgets.run() can run offline.
+    
+    """
+    
+    def __init__(self, path, realtime=False):
+        """
+        Create a Replayer reading from the given capture file.
+        
+        Args:
+            path: path of the capture file to read
+            realtime: if True, each replayed call returns at the same offset from the start of
+                the replay as it did in the recording, reproducing both each call's latency and the
+                gaps between calls, otherwise responses are returned as fast as possible
+        """
+        
+        self.path = path
+        self.realtime = realtime
+        self.started = None
+        self.lock = threading.Lock()
+        self.originals = {}
+        self.responses = {}
+        self.temp_dir = None
+        
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            header = json.loads(f.readline())
+            if header.get("capture_version") != CAPTURE_VERSION:
+                raise CaptureError(f"Unsupported capture version: {header.get('capture_version')}")
+            self.ledger = header.get("ledger") or {}
+            
+            for line in f:
+                record = json.loads(line)
+                key = call_key(record["service"], record["method"], record["args"], record["kwargs"])
+                self.responses.setdefault(key, []).append(record)
+        
+        logger.info(f"Loaded {sum(len(r) for r in self.responses.values())} recorded calls from: {path}")
+    
+    
+    def replay(self, service, method, args, kwargs):
+        """
+        Returns the next recorded response for a call, or raises the recorded error.
+        
+        Calls repeated more often than they were recorded keep returning the last response.
+        
+        Args:
+            service: "deadline" or "shotgrid"
+            method: name of the API call
+            args: positional arguments of the call
+            kwargs: keyword arguments of the call
+        """
+        
+        key = call_key(service, method, args, kwargs)
+        with self.lock:
+            records = self.responses.get(key)
+            if not records:
+                raise CaptureError(f"No recorded response for {service} {method}: {key}")
+            record = records.pop(0) if len(records) > 1 else records[0]
+        
+        if self.realtime:
+            # Calls that start late, e.g. behind a slower replay, return as soon as possible
+            delay = self.started + record["offset"] + record["duration"] - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        
+        if "error" in record:
+            # Callers check exception class names, e.g. AccessDeniedException
+            error_class = type(record["error"]["type"], (Exception,), {})
+            raise error_class(record["error"]["message"])
+        
+        return record["response"]
+    
+    
+    def install(self):
+        """
+        Patch the notifier's Deadline Cloud and ShotGrid entry points to replay calls, and deliver
+        alerts only as replayed ShotGrid Notes.
+        
+        """
+        
+        self.started = time.monotonic()
+        
+        for name in DEADLINE_CALLS:
+            self.originals[(budgets, name)] = getattr(budgets, name)
+            setattr(budgets, name, self._replayed("deadline", name))
+        
+        self.originals[(alerts, "get_shotgun")] = alerts.get_shotgun
+        alerts.get_shotgun = lambda *args, **kwargs: _ShotgunProxy(
+            {method: self._replayed("shotgrid", method) for method in SHOTGRID_CALLS}
+        )
+        
+        # Only ShotGrid Notes are replayed, webhook and SMTP sinks would deliver for real
+        replay_sinks = [sinks.ShotGridNoteSink()]
+        self.originals[(sinks, "get_sinks")] = sinks.get_sinks
+        sinks.get_sinks = lambda: replay_sinks
+        
+        # Keep replayed alerts out of the live alert ledger, starting from the ledger as it was recorded
+        self.temp_dir = tempfile.TemporaryDirectory(prefix="sg_notifications_replay_")
+        self.originals[(storage, "DATA_PATH")] = storage.DATA_PATH
+        storage.DATA_PATH = os.path.join(self.temp_dir.name, "notification_data.json")
+        with open(storage.DATA_PATH, "w") as f:
+            f.write(json.dumps(self.ledger))
+        
+        _use_cold_caches(self.originals, self.temp_dir.name)
+        
+        logger.info(f"Replaying Deadline Cloud and ShotGrid calls from: {self.path}")
+    
+    
+    def _replayed(self, service, method):
+        return lambda *args, **kwargs: self.replay(service, method, args, kwargs)
+    
+    
+    def uninstall(self):
+        """
+        Restore the patched entry points and discard the replay alert ledger and metadata cache.
+        
+        """
+        
+        for (module, name), original in self.originals.items():
+            setattr(module, name, original)
+        self.originals = {}
+        
+        if self.temp_dir:
+            self.temp_dir.cleanup()
+            self.temp_dir = None
+
+
+def _read_ledger():
+    """
+    Returns the contents of the live alert ledger, or an empty dict if it can't be read.
+    
+    """
+    
+    try:
+        return storage.get_stored_data()
+    except FileNotFoundError:
+        return {}
+    except:
+        logger.error("Couldn't read stored data")
+        logger.error(traceback.format_exc())
+        return {}
+
+
+def _use_cold_caches(originals, directory):
+    """
+    Point the metadata cache, group index and incomplete farms at empty files in directory, so every
+    list call is made while recording and every recorded call is used while replaying.
+    
+    Args:
+        originals: dict of (module, attribute name) to the original values to restore
+        directory: temporary directory for the cache files
+    """
+    
+    originals[(metadata_cache, "CACHE_PATH")] = metadata_cache.CACHE_PATH
+    originals[(metadata_cache, "_default_cache")] = metadata_cache._default_cache
+    metadata_cache.CACHE_PATH = os.path.join(directory, "metadata_cache.json")
+    metadata_cache._default_cache = None
+    
+    originals[(group_index, "INDEX_PATH")] = group_index.INDEX_PATH
+    originals[(alerts, "_group_index")] = alerts._group_index
+    originals[(alerts, "_quarantine")] = alerts._quarantine
+    group_index.INDEX_PATH = os.path.join(directory, "group_index.json")
+    alerts._group_index = None
+    alerts._quarantine = None
+    
+    originals[(cycle, "INCOMPLETE_FARMS_PATH")] = cycle.INCOMPLETE_FARMS_PATH
+    cycle.INCOMPLETE_FARMS_PATH = os.path.join(directory, "incomplete_farms.json")
+
+
+class _ShotgunProxy(object):
+    """Stands in for a Shotgun connection, exposing only the calls the notifier makes."""
+    
+    def __init__(self, methods):
+        self.__dict__.update(methods)
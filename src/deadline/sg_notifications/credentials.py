@@ -21,7 +21,7 @@ logger.addHandler(log_handler)
 CREDENTIALS_PATH = "~/.deadline/notifications/config_notifications.json"
 
 
-def get_credential(section, key):
+def get_credential(section, key, optional=False):
     """
     Get an entry from the credentials file.
     
@@ -30,6 +30,7 @@ def get_credential(section, key):
     Args:
         section: key name from the top level of the configuration file's data
         key: name of an entry inside the given section
+        optional: if True, a missing section is only logged at debug level
     """
     
     result = None
@@ -47,6 +48,8 @@ def get_credential(section, key):
             result = data[section][key]
         else:
             logger.debug(f"Key '{key}' not found in section '{section}' in credentials: {credentials_path}")
+    elif optional:
+        logger.debug(f"Section '{section}' not found in credentials: {credentials_path}")
     else:
         logger.error(f"Section '{section}' not found in credentials: {credentials_path}")
     
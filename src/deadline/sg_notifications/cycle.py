@@ -0,0 +1,163 @@
+import logging
+import logutil
+import time
+import traceback
+
+import credentials
+import storage
+
+# Logging to file
+logutil.add_file_handler()
+logger = logging.getLogger(__name__)
+logger.setLevel(logutil.get_deadline_config_level())
+
+# Logging to stdout
+log_handler = logging.StreamHandler()
+log_fmt = logging.Formatter(
+    "%(asctime)s - [%(levelname)-7s] "
+    "[%(module)s:%(funcName)s:%(lineno)d] %(message)s"
+)
+log_handler.setFormatter(log_fmt)
+logger.addHandler(log_handler)
+
+
+INCOMPLETE_FARMS_PATH = "~/.deadline/notifications/incomplete_farms.json"
+
+# Seconds a notification cycle may run before its remaining farm scans are abandoned
+DEFAULT_CYCLE_DEADLINE = 300
+
+
+class CycleDeadlineExceeded(Exception):
+    """Raised by work that checks a CycleDeadline after it has passed."""
+
+
+class CycleDeadline(object):
+    """
+    The point in time by which a notification cycle must finish, passed down to
+    every farm scan and alert delivery in the cycle.
+    
+    """
+    
+    def __init__(self, seconds=None):
+        """
+        Create a CycleDeadline.
+        
+        Args:
+            seconds: seconds from now until the deadline, or None for no deadline
+        """
+        
+        self.seconds = seconds
+        self.started = time.monotonic()
+        self.expires = None if seconds is None else self.started + seconds
+    
+    
+    @classmethod
+    def from_config(cls, seconds=None):
+        """
+        Returns a CycleDeadline starting now, lasting the given seconds, or cycle_deadline
+        from the deadline_cloud section of the configuration file.
+        
+        Args:
+            seconds: seconds until the deadline, overriding the configuration file
+        """
+        
+        if seconds is None:
+            try:
+                seconds = credentials.get_credential("deadline_cloud", "cycle_deadline")
+            except:
+                raise
+        
+        return cls(DEFAULT_CYCLE_DEADLINE if seconds is None else seconds)
+    
+    
+    def remaining(self):
+        """
+        Returns the seconds left until the deadline, 0 once it has passed, or None if there's no deadline.
+        
+        """
+        
+        if self.expires is None:
+            return None
+        return max(0, self.expires - time.monotonic())
+    
+    
+    def expired(self):
+        """
+        Returns True if the deadline has passed.
+        
+        """
+        
+        return self.expires is not None and time.monotonic() >= self.expires
+    
+    
+    def clamp(self, timeout):
+        """
+        Returns a timeout shortened to the time left until the deadline.
+        
+        Args:
+            timeout: seconds, or None to wait indefinitely
+        """
+        
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        if timeout is None:
+            return remaining
+        return min(timeout, remaining)
+    
+    
+    def check(self):
+        """
+        Raises CycleDeadlineExceeded if the deadline has passed.
+        
+        """
+        
+        if self.expired():
+            raise CycleDeadlineExceeded(f"Cycle deadline of {self.seconds}s exceeded")
+
+
+def get_incomplete_farms(studio_hostname):
+    """
+    Returns a list of the farm IDs of a studio whose scans didn't finish in the previous cycle.
+    
+    Args:
+        studio_hostname: Deadline Cloud studio web host name
+    """
+    
+    try:
+        return storage.get_stored_data(INCOMPLETE_FARMS_PATH).get(studio_hostname, [])
+    except FileNotFoundError:
+        return []
+    except:
+        logger.error("Couldn't read incomplete farms")
+        logger.error(traceback.format_exc())
+        return []
+
+
+def set_incomplete_farms(studio_hostname, farm_ids):
+    """
+    Stores the farm IDs of a studio whose scans didn't finish this cycle, so they're scanned first next cycle.
+    
+    Args:
+        studio_hostname: Deadline Cloud studio web host name
+        farm_ids: list of Deadline Cloud farm IDs
+    """
+    
+    try:
+        storage.update_stored_data({studio_hostname: list(farm_ids)}, INCOMPLETE_FARMS_PATH)
+    except:
+        logger.error("Couldn't write incomplete farms")
+        logger.error(traceback.format_exc())
+
+
+def prioritize_farms(farms, incomplete_farm_ids):
+    """
+    Returns farms reordered so the ones left incomplete last cycle come first, in their previous order.
+    
+    Args:
+        farms: a list of Farm records
+        incomplete_farm_ids: farm IDs to scan first
+    """
+    
+    order = {farm_id: index for index, farm_id in enumerate(incomplete_farm_ids)}
+    return sorted(farms, key=lambda farm: order.get(farm.farm_id, len(order)))
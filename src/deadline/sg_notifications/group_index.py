@@ -0,0 +1,299 @@
+import logging
+import logutil
+import threading
+import time
+import traceback
+
+import storage
+
+# Logging to file
+logutil.add_file_handler()
+logger = logging.getLogger(__name__)
+logger.setLevel(logutil.get_deadline_config_level())
+
+# Logging to stdout
+log_handler = logging.StreamHandler()
+log_fmt = logging.Formatter(
+    "%(asctime)s - [%(levelname)-7s] "
+    "[%(module)s:%(funcName)s:%(lineno)d] %(message)s"
+)
+log_handler.setFormatter(log_fmt)
+logger.addHandler(log_handler)
+
+
+INDEX_PATH = "~/.deadline/notifications/group_index.json"
+
+# ShotGrid EventLogEntry event types for changes to Group entities
+GROUP_EVENT_TYPES = [
+    "Shotgun_Group_New",
+    "Shotgun_Group_Change",
+    "Shotgun_Group_Retirement",
+    "Shotgun_Group_Revival",
+]
+GROUP_RETIREMENT_EVENT_TYPE = "Shotgun_Group_Retirement"
+
+# EventLogEntry records read per ShotGrid request
+EVENT_PAGE_SIZE = 500
+
+# Seconds between EventLogEntry polls
+DEFAULT_POLL_INTERVAL = 5
+
+
+class GroupIndex(object):
+    """
+    In-process index of the notification Groups in ShotGrid, kept current by tailing
+    EventLogEntry records for Group entities from a persisted cursor.
+    
+    Groups are only fetched again when an event shows they changed.
+    
+    """
+    
+    def __init__(self, get_shotgun, code_filter, fields, index_path=None, poll_interval=None):
+        """
+        Create a GroupIndex.
+        
+        Args:
+            get_shotgun: function returning a ShotGrid connection
+            code_filter: text that the code of every indexed Group contains
+            fields: Group fields to fetch
+            index_path: JSON file the index and cursor are persisted to. Defaults to INDEX_PATH.
+            poll_interval: seconds after which reading the index polls for new events
+        """
+        
+        self.get_shotgun = get_shotgun
+        self.code_filter = code_filter
+        self.fields = fields
+        self.index_path = index_path
+        self.poll_interval = DEFAULT_POLL_INTERVAL if poll_interval is None else poll_interval
+        self.groups = None
+        self.cursor = None
+        self.polled_at = 0
+        self.listeners = []
+        self.lock = threading.RLock()
+    
+    
+    def get_groups(self):
+        """
+        Returns a list of the indexed Group entities, polling for changes if the last poll is stale.
+        
+        """
+        
+        with self.lock:
+            if self.groups is None:
+                self._load()
+            if time.monotonic() - self.polled_at > self.poll_interval:
+                self.poll()
+            
+            return [dict(group) for group in self.groups.values()]
+    
+    
+    def add_listener(self, listener):
+        """
+        Call a function with the list of Group entities that were added or changed, after every update to the index.
+        A full reload of the index isn't a change, so listeners aren't called for it.
+        
+        Args:
+            listener: function taking a list of Group entities
+        """
+        
+        self.listeners.append(listener)
+    
+    
+    def add_group(self, group):
+        """
+        Add a Group entity created by the notifier to the index.
+        
+        Args:
+            group: ShotGrid Group entity
+        """
+        
+        with self.lock:
+            if self.groups is None:
+                self._load()
+            self.groups[group["id"]] = {field: group.get(field) for field in ["type", "id"] + self.fields}
+            self._save()
+            self._notify([self.groups[group["id"]]])
+    
+    
+    def poll(self):
+        """
+        Apply Group changes from EventLogEntry records newer than the cursor.
+        
+        Returns the number of changed Groups.
+        
+        """
+        
+        with self.lock:
+            if self.groups is None:
+                self._load()
+            
+            sg = self.get_shotgun()
+            cursor = self.cursor
+            changed_ids = set()
+            retired_ids = set()
+            
+            try:
+                while True:
+                    events = sg.find(
+                        "EventLogEntry",
+                        filters=[["id", "greater_than", cursor], ["event_type", "in", GROUP_EVENT_TYPES]],
+                        fields=["id", "event_type", "entity", "meta"],
+                        order=[{"field_name": "id", "direction": "asc"}],
+                        limit=EVENT_PAGE_SIZE
+                    )
+                    
+                    for event in events:
+                        group_id = (event.get("entity") or {}).get("id") or (event.get("meta") or {}).get("entity_id")
+                        if group_id is None:
+                            continue
+                        if event["event_type"] == GROUP_RETIREMENT_EVENT_TYPE:
+                            retired_ids.add(group_id)
+                            changed_ids.discard(group_id)
+                        else:
+                            changed_ids.add(group_id)
+                            retired_ids.discard(group_id)
+                        cursor = max(cursor, event["id"])
+                    
+                    if len(events) < EVENT_PAGE_SIZE:
+                        break
+            except:
+                logger.error("Couldn't read Group events, reloading all Groups")
+                logger.error(traceback.format_exc())
+                return self._try_reload(sg)
+            finally:
+                self.polled_at = time.monotonic()
+            
+            # Fetch the changed Groups before touching the index, so a failed fetch leaves
+            # the index and cursor as they were and the next poll reads the same events
+            changed_groups = []
+            if changed_ids:
+                try:
+                    changed_groups = sg.find(
+                        "Group",
+                        filters=[["id", "in", sorted(changed_ids)], ["code", "contains", self.code_filter]],
+                        fields=self.fields
+                    )
+                except:
+                    logger.error("Couldn't fetch changed Groups, keeping the group index until the next poll")
+                    logger.error(traceback.format_exc())
+                    return 0
+            
+            for group_id in retired_ids:
+                group = self.groups.pop(group_id, None)
+                if group:
+                    logger.info(f"Group retired: {group['code']}")
+            
+            # Groups whose code no longer matches the filter are dropped from the index
+            for group_id in changed_ids:
+                self.groups.pop(group_id, None)
+            for group in changed_groups:
+                self.groups[group["id"]] = group
+                logger.info(f"Group changed: {group['code']}")
+            
+            if cursor != self.cursor or changed_ids or retired_ids:
+                self.cursor = cursor
+                self._save()
+            
+            if changed_groups:
+                self._notify(changed_groups)
+            
+            return len(changed_ids) + len(retired_ids)
+    
+    
+    def _load(self):
+        # Warm start from the persisted index, or fetch every Group once
+        try:
+            data = storage.get_stored_data(self.index_path or INDEX_PATH)
+            self.groups = {group["id"]: group for group in data["groups"]}
+            self.cursor = data["cursor"]
+            logger.debug(f"Loaded {len(self.groups)} Groups from the group index at event: {self.cursor}")
+            return
+        except FileNotFoundError:
+            pass
+        except:
+            logger.warning("Couldn't read the group index, reloading all Groups")
+            logger.warning(traceback.format_exc())
+        
+        self._reload(self.get_shotgun())
+    
+    
+    def _reload(self, sg):
+        # Start the cursor at the latest event before the fetch so no change is missed
+        latest_event = sg.find_one("EventLogEntry", filters=[], fields=["id"], order=[{"field_name": "id", "direction": "desc"}])
+        groups = sg.find("Group", filters=[["code", "contains", self.code_filter]], fields=self.fields)
+        
+        self.cursor = latest_event["id"] if latest_event else 0
+        self.groups = {group["id"]: group for group in groups}
+        self.polled_at = time.monotonic()
+        logger.info(f"Loaded {len(self.groups)} Groups at event: {self.cursor}")
+        
+        self._save()
+    
+    
+    def _try_reload(self, sg):
+        # Keep the index as it was if ShotGrid can't be read at all
+        try:
+            self._reload(sg)
+        except:
+            logger.error("Couldn't reload Groups, keeping the group index until the next poll")
+            logger.error(traceback.format_exc())
+            return 0
+        return len(self.groups)
+    
+    
+    def _notify(self, groups):
+        for listener in self.listeners:
+            try:
+                listener(groups)
+            except:
+                logger.error(traceback.format_exc())
+    
+    
+    def _save(self):
+        try:
+            storage.update_stored_data(
+                {"cursor": self.cursor, "groups": list(self.groups.values())},
+                self.index_path or INDEX_PATH
+            )
+        except:
+            logger.error("Couldn't write the group index")
+            logger.error(traceback.format_exc())
+
+
+class GroupWatcher(threading.Thread):
+    """
+    Background thread that polls a GroupIndex for Group changes, so edits made in
+    ShotGrid show up within seconds.
+    
+    """
+    
+    def __init__(self, index, interval=None):
+        """
+        Create a GroupWatcher.
+        
+        Args:
+            index: the GroupIndex to keep current
+            interval: seconds between polls
+        """
+        
+        super().__init__(name="group_watcher", daemon=True)
+        self.index = index
+        self.interval = interval or index.poll_interval
+        self.stopped = threading.Event()
+    
+    
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.index.poll()
+            except:
+                logger.error(traceback.format_exc())
+    
+    
+    def stop(self):
+        """
+        Stop polling after the current poll.
+        
+        """
+        
+        self.stopped.set()
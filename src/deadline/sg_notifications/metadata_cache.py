@@ -0,0 +1,272 @@
+import dataclasses
+import logging
+import logutil
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import credentials
+import records
+import storage
+
+# Logging to file
+logutil.add_file_handler()
+logger = logging.getLogger(__name__)
+logger.setLevel(logutil.get_deadline_config_level())
+
+# Logging to stdout
+log_handler = logging.StreamHandler()
+log_fmt = logging.Formatter(
+    "%(asctime)s - [%(levelname)-7s] "
+    "[%(module)s:%(funcName)s:%(lineno)d] %(message)s"
+)
+log_handler.setFormatter(log_fmt)
+logger.addHandler(log_handler)
+
+
+CACHE_PATH = "~/.deadline/notifications/metadata_cache.json"
+
+# Seconds before cached farm and queue lists are refreshed
+DEFAULT_FARM_TTL = 3600
+DEFAULT_QUEUE_TTL = 600
+
+
+class MetadataCache(object):
+    """
+    Persistent cache of Deadline Cloud farm and queue records, stored as JSON next to
+    the notifier's alert data.
+    
+    Expired entries are still returned while they're refreshed in the background,
+    so a restarted notifier can start scanning budgets right away.
+    
+    """
+    
+    def __init__(self, cache_path=None, farm_ttl=None, queue_ttl=None):
+        """
+        Create a MetadataCache.
+        
+        Args:
+            cache_path: JSON file the cache is persisted to. Defaults to CACHE_PATH.
+            farm_ttl: seconds before a studio's farm list is refreshed
+            queue_ttl: seconds before a farm's queue list is refreshed
+        """
+        
+        self.cache_path = cache_path
+        self.farm_ttl = farm_ttl or DEFAULT_FARM_TTL
+        self.queue_ttl = queue_ttl or DEFAULT_QUEUE_TTL
+        self.entries = None
+        self.unknown_queues = {}
+        self.refreshing = set()
+        self.lock = threading.RLock()
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="metadata_cache")
+    
+    
+    @classmethod
+    def from_config(cls):
+        """
+        Returns a MetadataCache with TTLs from the deadline_cloud section of the configuration file.
+        
+        """
+        
+        try:
+            farm_ttl = credentials.get_credential("deadline_cloud", "farm_cache_ttl")
+            queue_ttl = credentials.get_credential("deadline_cloud", "queue_cache_ttl")
+        except:
+            raise
+        
+        return cls(farm_ttl=farm_ttl, queue_ttl=queue_ttl)
+    
+    
+    def get_farms(self, studio_hostname, loader):
+        """
+        Returns the cached Farm records for a studio, calling loader if none are cached.
+        
+        Args:
+            studio_hostname: Deadline Cloud studio web host name
+            loader: function returning a list of Farm records
+        """
+        
+        return self._get(f"farms:{studio_hostname}", loader, self.farm_ttl)
+    
+    
+    def get_queues(self, farm_id, loader):
+        """
+        Returns the cached Queue records for a farm, calling loader if none are cached.
+        
+        Args:
+            farm_id: Deadline Cloud farm ID
+            loader: function returning a list of Queue records
+        """
+        
+        return self._get(f"queues:{farm_id}", loader, self.queue_ttl)
+    
+    
+    def invalidate_farms(self, studio_hostname):
+        """
+        Drop the cached farms for a studio so the next read fetches them again.
+        
+        Args:
+            studio_hostname: Deadline Cloud studio web host name
+        """
+        
+        self._invalidate(f"farms:{studio_hostname}")
+    
+    
+    def invalidate_queues(self, farm_id):
+        """
+        Drop the cached queues for a farm so the next read fetches them again.
+        
+        Args:
+            farm_id: Deadline Cloud farm ID
+        """
+        
+        self._invalidate(f"queues:{farm_id}")
+    
+    
+    def mark_unknown_queue(self, scope, queue_id):
+        """
+        Remember for one queue TTL that a queue wasn't found, even after refreshing the cache,
+        so repeated lookups don't refresh it again.
+        
+        Args:
+            scope: the farm ID or studio host name the queue was looked up in
+            queue_id: Deadline Cloud queue ID
+        """
+        
+        with self.lock:
+            self.unknown_queues[(scope, queue_id)] = time.monotonic() + self.queue_ttl
+    
+    
+    def is_unknown_queue(self, scope, queue_id):
+        """
+        Returns True if a queue recently wasn't found in a farm or studio.
+        
+        Args:
+            scope: the farm ID or studio host name the queue is looked up in
+            queue_id: Deadline Cloud queue ID
+        """
+        
+        with self.lock:
+            expires = self.unknown_queues.get((scope, queue_id))
+            if expires is None:
+                return False
+            if time.monotonic() >= expires:
+                del self.unknown_queues[(scope, queue_id)]
+                return False
+            return True
+    
+    
+    def _get(self, key, loader, ttl):
+        with self.lock:
+            self._load()
+            entry = self.entries.get(key)
+        
+        if entry is None:
+            return self._refresh(key, loader, ttl)
+        
+        if time.time() - entry["fetched_at"] > entry["ttl"]:
+            # Serve the stale entry while it's refreshed in the background
+            with self.lock:
+                if key not in self.refreshing:
+                    self.refreshing.add(key)
+                    self.executor.submit(self._refresh_in_background, key, loader, ttl)
+        
+        return entry["records"]
+    
+    
+    def _refresh(self, key, loader, ttl):
+        items = loader()
+        entry = {"fetched_at": time.time(), "ttl": ttl, "records": items}
+        
+        with self.lock:
+            self.entries[key] = entry
+            self._save(key, entry)
+        
+        return items
+    
+    
+    def _refresh_in_background(self, key, loader, ttl):
+        try:
+            self._refresh(key, loader, ttl)
+            logger.debug(f"Refreshed metadata cache entry: {key}")
+        except:
+            logger.error(f"Couldn't refresh metadata cache entry: {key}")
+            logger.error(traceback.format_exc())
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+    
+    
+    def _invalidate(self, key):
+        with self.lock:
+            self._load()
+            if self.entries.pop(key, None) is not None:
+                logger.info(f"Invalidated metadata cache entry: {key}")
+                self._save(key, None)
+    
+    
+    def _load(self):
+        # Read the persisted entries once, on first use
+        if self.entries is not None:
+            return
+        
+        self.entries = {}
+        try:
+            data = storage.get_stored_data(self.cache_path or CACHE_PATH)
+        except FileNotFoundError:
+            return
+        except:
+            logger.error("Couldn't read metadata cache")
+            logger.error(traceback.format_exc())
+            return
+        
+        for key, entry in data.items():
+            if not entry:
+                continue
+            try:
+                record_type = _get_record_type(key)
+                entry["records"] = [record_type(**record) for record in entry["records"]]
+                self.entries[key] = entry
+            except:
+                logger.warning(f"Discarding unreadable metadata cache entry: {key}")
+        
+        logger.debug(f"Loaded {len(self.entries)} metadata cache entries")
+    
+    
+    def _save(self, key, entry):
+        if entry is not None:
+            entry = dict(entry, records=[dataclasses.asdict(record) for record in entry["records"]])
+        
+        try:
+            storage.update_stored_data({key: entry}, self.cache_path or CACHE_PATH)
+        except:
+            logger.error("Couldn't write metadata cache")
+            logger.error(traceback.format_exc())
+
+
+def _get_record_type(key):
+    if key.startswith("farms:"):
+        return records.Farm
+    if key.startswith("queues:"):
+        return records.Queue
+    raise KeyError(key)
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache():
+    """
+    Returns the process-wide MetadataCache, creating it from the configuration file on first use.
+    
+    """
+    
+    global _default_cache
+    
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = MetadataCache.from_config()
+    
+    return _default_cache
@@ -5,7 +5,12 @@ import sys
 import time
 import traceback
 
+import alerts
 import budgets
+import capture
+import group_index
+import status_api
+import tracing
 
 # Logging to file
 logutil.add_file_handler()
@@ -27,22 +32,133 @@ def main():
 
     Command line arguments:
         -d (--delay): Refresh delay in seconds.
+        --record: Capture Deadline Cloud and ShotGrid traffic to a file.
+        --replay: Run offline against a capture file.
+        --replay-realtime: Replay calls at their originally recorded timing.
+        --rebuild-ledger: Rebuild the alert ledger from ShotGrid Notes at startup.
+        --status-port: Serve the local budget status API on this port.
+        --status-host: Address the budget status API listens on.
+        --cycle-deadline: Seconds each notification pass may run.
+        --trace: Trace every notification pass to a directory.
     """
     parser = argparse.ArgumentParser()
     
     parser.add_argument(
         '-d', '--delay',
         help='Set refresh delay in seconds. Specify 0 to run only once.',
+        type=float,
         default=15
     )
+    parser.add_argument(
+        '--record',
+        help='Record all Deadline Cloud and ShotGrid calls to the given capture file.',
+        default=None
+    )
+    parser.add_argument(
+        '--replay',
+        help='Replay Deadline Cloud and ShotGrid calls from the given capture file instead of calling live services.',
+        default=None
+    )
+    parser.add_argument(
+        '--replay-realtime',
+        help='When replaying, take as long as each call originally took instead of replaying as fast as possible.',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--rebuild-ledger',
+        help='Rebuild the alert ledger from ShotGrid Notes at startup, even if it is readable.',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--cycle-deadline',
+        help='Seconds each notification pass may run before unfinished farm scans are left for the next pass. '
+             'Defaults to cycle_deadline in the configuration file, or 300.',
+        type=float,
+        default=None
+    )
+    parser.add_argument(
+        '--trace',
+        help='Write a trace of every notification pass to the given directory, '
+             'instead of sampling passes as configured in the tracing section of the configuration file.',
+        nargs='?',
+        const=tracing.TRACES_PATH,
+        default=None
+    )
+    parser.add_argument(
+        '--status-port',
+        help='Serve the latest budget status of every queue as JSON on this port. Disabled by default.',
+        type=int,
+        default=None
+    )
+    parser.add_argument(
+        '--status-host',
+        help='Address the budget status API listens on.',
+        default=status_api.DEFAULT_HOST
+    )
 
     namespace = parser.parse_args(sys.argv[1:])
     
+    if namespace.record and namespace.replay:
+        parser.error("--record and --replay can't be used together")
+    
+    # Trace a sample of cycles as configured, or every cycle with --trace
+    try:
+        tracing.set_tracer(tracing.Tracer.from_config(
+            sample_rate=1.0 if namespace.trace else None,
+            path=namespace.trace
+        ))
+    except:
+        logger.error("Couldn't configure tracing")
+        logger.error(traceback.format_exc())
+    
+    harness = None
+    if namespace.record:
+        harness = capture.Recorder(namespace.record)
+    elif namespace.replay:
+        harness = capture.Replayer(namespace.replay, realtime=namespace.replay_realtime)
+    
+    # Rebuild a lost alert ledger before the first cycle so alerts aren't sent again.
+    # Recordings capture the ledger after recovery, and replays start from the recorded ledger.
+    if not namespace.replay:
+        try:
+            budgets.recover_alert_ledger(force=namespace.rebuild_ledger)
+        except:
+            logger.error("Couldn't recover the alert ledger")
+            logger.error(traceback.format_exc())
+    
+    if harness:
+        harness.install()
+    
+    watcher = None
+    try:
+        if namespace.status_port is not None:
+            status_api.start_server(namespace.status_port, host=namespace.status_host)
+        
+        # Keep the ShotGrid group index current between cycles
+        if namespace.delay > 0:
+            watcher = group_index.GroupWatcher(alerts.get_group_index())
+            watcher.start()
+        
+        run_cycles(namespace)
+    finally:
+        if watcher:
+            watcher.stop()
+        status_api.stop_server()
+        if harness:
+            harness.uninstall()
+
+
+def run_cycles(namespace):
+    """Run notification passes until one pass completes with no refresh delay.
+
+    Args:
+        namespace: parsed command line arguments
+    """
     # Check all budgets on all farms across all studios,
     # repeated every namespace.delay seconds
     while True:
         try:
-            results = budgets.run()
+            results = budgets.run(cycle_deadline=namespace.cycle_deadline)
             logger.info(results)
         except:
             logger.error(traceback.format_exc())
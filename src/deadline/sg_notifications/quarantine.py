@@ -0,0 +1,150 @@
+import logging
+import logutil
+import threading
+import time
+
+# Logging to file
+logutil.add_file_handler()
+logger = logging.getLogger(__name__)
+logger.setLevel(logutil.get_deadline_config_level())
+
+# Logging to stdout
+log_handler = logging.StreamHandler()
+log_fmt = logging.Formatter(
+    "%(asctime)s - [%(levelname)-7s] "
+    "[%(module)s:%(funcName)s:%(lineno)d] %(message)s"
+)
+log_handler.setFormatter(log_fmt)
+logger.addHandler(log_handler)
+
+
+# Seconds before a quarantined queue is first checked again, doubled after each failed check
+DEFAULT_RECHECK_INTERVAL = 60
+MAX_RECHECK_INTERVAL = 3600
+
+
+class QueueQuarantine(object):
+    """
+    Negative cache of queues whose alerts can't be routed to ShotGrid, for example because
+    their notification Group is missing or has no Group Project.
+    
+    Quarantined queues are skipped until their next check, at exponentially growing intervals,
+    and released as soon as a change to a matching Group shows up in the group index.
+    
+    """
+    
+    def __init__(self, recheck_interval=None, max_recheck_interval=None):
+        """
+        Create a QueueQuarantine.
+        
+        Args:
+            recheck_interval: seconds before a quarantined queue is first checked again
+            max_recheck_interval: longest interval between checks of a quarantined queue
+        """
+        
+        self.recheck_interval = recheck_interval or DEFAULT_RECHECK_INTERVAL
+        self.max_recheck_interval = max_recheck_interval or MAX_RECHECK_INTERVAL
+        self.entries = {}
+        self.added = []
+        self.released = []
+        self.lock = threading.Lock()
+    
+    
+    def get_entry(self, queue_id):
+        """
+        Returns the quarantine entry of a queue that shouldn't be checked yet, or None.
+        
+        Args:
+            queue_id: Deadline Cloud queue ID
+        """
+        
+        with self.lock:
+            entry = self.entries.get(queue_id)
+            if entry is None or time.monotonic() >= entry["next_check"]:
+                return None
+            return dict(entry)
+    
+    
+    def add(self, queue_id, queue_name, reason):
+        """
+        Quarantine a queue after a failed check, doubling the interval before its next check.
+        
+        Only the first failure of a queue is logged as a warning.
+        
+        Args:
+            queue_id: Deadline Cloud queue ID
+            queue_name: Deadline Cloud queue name
+            reason: why the queue's alerts can't be routed
+        """
+        
+        with self.lock:
+            entry = self.entries.get(queue_id)
+            if entry is None:
+                entry = {"queue_id": queue_id, "queue_name": queue_name, "failures": 0, "since": time.time()}
+                self.entries[queue_id] = entry
+                self.added.append(queue_id)
+                logger.warning(f"Quarantined queue {queue_name} ({queue_id}): {reason}")
+            
+            entry["reason"] = reason
+            entry["failures"] += 1
+            interval = min(self.max_recheck_interval, self.recheck_interval * 2 ** (entry["failures"] - 1))
+            entry["next_check"] = time.monotonic() + interval
+            logger.debug(f"Queue {queue_id} will be checked again in {interval}s")
+    
+    
+    def release(self, queue_id):
+        """
+        Remove a queue from quarantine, so its next alert is routed normally.
+        
+        Args:
+            queue_id: Deadline Cloud queue ID
+        """
+        
+        with self.lock:
+            entry = self.entries.pop(queue_id, None)
+            if entry is not None:
+                self.released.append(queue_id)
+                logger.info(f"Released queue {entry['queue_name']} ({queue_id}) from quarantine")
+    
+    
+    def release_groups(self, groups):
+        """
+        Release every quarantined queue matching one of the given changed Groups that now has
+        a Group Project, so its alerts can be routed. Other changes leave the queue quarantined.
+        
+        Args:
+            groups: a list of ShotGrid Group entities that were created or changed
+        """
+        
+        codes = [group.get("code") or "" for group in groups if group.get("sg_group_project")]
+        with self.lock:
+            queue_ids = [
+                queue_id for queue_id, entry in self.entries.items()
+                if any(queue_id in code or entry["queue_name"] in code for code in codes)
+            ]
+        
+        for queue_id in queue_ids:
+            self.release(queue_id)
+    
+    
+    def report(self):
+        """
+        Log a summary of the quarantined queues, as a warning only if the quarantine changed
+        since the last report. Intended to be called once per cycle.
+        
+        Returns the number of quarantined queues.
+        
+        """
+        
+        with self.lock:
+            count = len(self.entries)
+            added, self.added = self.added, []
+            released, self.released = self.released, []
+            queues = ", ".join(f"{entry['queue_name']} ({entry['reason']})" for entry in self.entries.values())
+        
+        if added or released:
+            logger.warning(f"unroutable_queues={count} added={len(added)} released={len(released)}: {queues}")
+        else:
+            logger.debug(f"unroutable_queues={count}")
+        
+        return count
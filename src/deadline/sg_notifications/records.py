@@ -0,0 +1,86 @@
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True, slots=True)
+class Farm:
+    """
+    A Deadline Cloud farm, holding only the fields the notifier uses.
+    
+    """
+    
+    farm_id: str
+    display_name: str
+    
+    @classmethod
+    def from_api(cls, farm):
+        """
+        Returns a Farm parsed from a deadline:ListFarms response item.
+        
+        Args:
+            farm: Deadline Cloud farm dict
+        """
+        
+        return cls(farm_id=farm["farmId"], display_name=farm["displayName"])
+
+
+@dataclass(frozen=True, slots=True)
+class Queue:
+    """
+    A Deadline Cloud queue, holding only the fields the notifier uses.
+    
+    """
+    
+    queue_id: str
+    farm_id: str
+    display_name: str
+    default_budget_action: str | None
+    
+    @classmethod
+    def from_api(cls, queue, farm_id=None):
+        """
+        Returns a Queue parsed from a deadline:ListQueues response item.
+        
+        Args:
+            queue: Deadline Cloud queue dict
+            farm_id: Deadline Cloud farm ID, used if the queue dict doesn't include one
+        """
+        
+        return cls(
+            queue_id=queue["queueId"],
+            farm_id=queue.get("farmId", farm_id),
+            display_name=queue["displayName"],
+            default_budget_action=queue.get("defaultBudgetAction")
+        )
+
+
+@dataclass(frozen=True, slots=True)
+class Budget:
+    """
+    A Deadline Cloud budget, holding only the fields the notifier uses.
+    
+    Budgets in Deadline Cloud are always USD.
+    
+    """
+    
+    budget_id: str
+    queue_id: str | None
+    status: str
+    approximate_dollar_limit: float
+    approximate_dollar_usage: float
+    
+    @classmethod
+    def from_api(cls, budget):
+        """
+        Returns a Budget parsed from a deadline:ListBudgets response item.
+        
+        Args:
+            budget: Deadline Cloud budget dict
+        """
+        
+        return cls(
+            budget_id=budget["budgetId"],
+            queue_id=budget.get("usageTrackingResource", {}).get("queueId"),
+            status=budget["status"],
+            approximate_dollar_limit=budget["approximateDollarLimit"],
+            approximate_dollar_usage=budget.get("usages", {}).get("approximateDollarUsage", 0.0)
+        )
@@ -0,0 +1,446 @@
+import json
+import logging
+import logutil
+import smtplib
+import threading
+import time
+import traceback
+import urllib.request
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass
+from email.message import EmailMessage
+
+import alerts
+import credentials
+import tracing
+
+# Logging to file
+logutil.add_file_handler()
+logger = logging.getLogger(__name__)
+logger.setLevel(logutil.get_deadline_config_level())
+
+# Logging to stdout
+log_handler = logging.StreamHandler()
+log_fmt = logging.Formatter(
+    "%(asctime)s - [%(levelname)-7s] "
+    "[%(module)s:%(funcName)s:%(lineno)d] %(message)s"
+)
+log_handler.setFormatter(log_fmt)
+logger.addHandler(log_handler)
+
+
+# Sinks used when none are configured
+DEFAULT_SINKS = [{"type": "shotgrid"}]
+
+# Longest wait between checks of running deliveries for timeouts
+DELIVERY_POLL_INTERVAL = 0.1
+
+# Sinks created from the configuration file, reused across cycles so each keeps its worker threads
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+
+@dataclass(frozen=True, slots=True)
+class Alert:
+    """
+    A budget alert to deliver to every configured sink.
+    
+    """
+    
+    farm_id: str
+    farm_name: str
+    farm_hostname: str
+    queue_id: str
+    queue_name: str
+    budget_id: str
+    budget_limit: float
+    default_budget_action: str | None
+    threshold: float
+    
+    @property
+    def budget_limit_formatted(self):
+        # Budgets in Deadline Cloud are always USD
+        # Apply dollar symbol to budget limit with commas as thousands separators
+        return "${:0,.2f}".format(self.budget_limit)
+    
+    def format(self):
+        """
+        Returns a tuple of the alert subject and text.
+        
+        """
+        
+        return alerts.format_budget_alert(
+            farm_id=self.farm_id,
+            farm_name=self.farm_name,
+            farm_hostname=self.farm_hostname,
+            queue_name=self.queue_name,
+            budget_id=self.budget_id,
+            budget_limit=self.budget_limit_formatted,
+            default_budget_action=self.default_budget_action,
+            threshold=self.threshold
+        )
+
+
+class Sink(object):
+    """
+    A destination for budget alerts. Subclasses implement send().
+    
+    """
+    
+    type_name = None
+    default_timeout = 30
+    default_max_workers = 4
+    
+    def __init__(self, name=None, timeout=None, max_workers=None):
+        """
+        Create a Sink.
+        
+        Each sink delivers on its own worker threads, so a hung sink can't hold up the others.
+        A delivery that overruns its timeout keeps its worker until the underlying call returns.
+        
+        Args:
+            name: name of the sink in logs, defaults to its type
+            timeout: seconds a delivery may run, from when it starts, before giving up on it
+            max_workers: deliveries this sink runs at once
+        """
+        
+        self.name = name or self.type_name
+        self.timeout = timeout or self.default_timeout
+        self.max_workers = max_workers or self.default_max_workers
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=f"sink_{self.name}")
+    
+    
+    def send(self, alert):
+        """
+        Deliver an alert. Raises an exception if the delivery fails.
+        
+        Args:
+            alert: the Alert to deliver
+        """
+        
+        raise NotImplementedError
+
+
+class ShotGridNoteSink(Sink):
+    """
+    Delivers alerts as ShotGrid Notes addressed to the queue's notification Group.
+    
+    Each Note carries an idempotency marker so the alert ledger can be rebuilt from ShotGrid.
+    
+    """
+    
+    type_name = "shotgrid"
+    default_timeout = 30
+    
+    def send(self, alert):
+        return alerts.send_budget_alert_note(
+            farm_id=alert.farm_id,
+            farm_name=alert.farm_name,
+            farm_hostname=alert.farm_hostname,
+            queue_name=alert.queue_name,
+            budget_id=alert.budget_id,
+            budget_limit=alert.budget_limit_formatted,
+            default_budget_action=alert.default_budget_action,
+            threshold=alert.threshold,
+            marker=alerts.format_alert_marker(alert.budget_id, alert.budget_limit, alert.threshold),
+            queue_id=alert.queue_id
+        )
+
+
+class WebhookSink(Sink):
+    """
+    Delivers alerts as JSON POST requests, by default as Slack-style {"text": ...} messages.
+    
+    """
+    
+    type_name = "webhook"
+    default_timeout = 10
+    
+    def __init__(self, url=None, payload="slack", headers=None, **kwargs):
+        """
+        Create a WebhookSink.
+        
+        Args:
+            url: URL the alerts are posted to
+            payload: "slack" to post {"text": ...}, or "json" to post every alert field
+            headers: extra HTTP headers for each request
+        """
+        
+        super().__init__(**kwargs)
+        
+        if not url:
+            raise ValueError("A webhook sink requires a url")
+        
+        self.url = url
+        self.payload = payload
+        self.headers = headers or {}
+    
+    
+    def send(self, alert):
+        subject, text = alert.format()
+        
+        if self.payload == "json":
+            body = dict(asdict(alert), subject=subject, text=text)
+        else:
+            body = {"text": f"*{subject}*\n{text}"}
+        
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(body).encode("utf-8"),
+            headers=dict({"Content-Type": "application/json"}, **self.headers),
+            method="POST"
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return response.status
+
+
+class SmtpSink(Sink):
+    """
+    Delivers alerts as plain text email through an SMTP server.
+    
+    """
+    
+    type_name = "smtp"
+    default_timeout = 30
+    
+    def __init__(self, host="localhost", port=25, sender=None, recipients=None, starttls=False, username=None, password=None, **kwargs):
+        """
+        Create a SmtpSink.
+        
+        Args:
+            host: SMTP server host name
+            port: SMTP server port
+            sender: From address of the alert emails
+            recipients: list of addresses the alert emails are sent to
+            starttls: if True, upgrade the connection with STARTTLS before sending
+            username: SMTP login user name, if the server requires one
+            password: SMTP login password
+        """
+        
+        super().__init__(**kwargs)
+        
+        if not sender or not recipients:
+            raise ValueError("An smtp sink requires a sender and recipients")
+        
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.recipients = recipients
+        self.starttls = starttls
+        self.username = username
+        self.password = password
+    
+    
+    def send(self, alert):
+        subject, text = alert.format()
+        
+        message = EmailMessage()
+        message["Subject"] = subject
+        message["From"] = self.sender
+        message["To"] = ", ".join(self.recipients)
+        message.set_content(text)
+        
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            if self.starttls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password)
+            return smtp.send_message(message)
+
+
+SINK_TYPES = {sink_type.type_name: sink_type for sink_type in (ShotGridNoteSink, WebhookSink, SmtpSink)}
+
+
+def create_sink(sink_config):
+    """
+    Create a Sink from its configuration.
+    
+    Returns the created Sink.
+    
+    Args:
+        sink_config: a dict with the sink "type" and its arguments, e.g. {"type": "webhook", "url": "..."}
+    """
+    
+    sink_config = dict(sink_config)
+    sink_type = sink_config.pop("type", None)
+    if sink_type not in SINK_TYPES:
+        raise ValueError(f"Unknown sink type: {sink_type}")
+    
+    return SINK_TYPES[sink_type](**sink_config)
+
+
+def get_sinks():
+    """
+    Get the sinks from the notifications section of the configuration file.
+    
+    Returns a list of Sinks, a ShotGrid Note sink if none are configured.
+    Sinks with unchanged configuration are reused.
+    
+    Unnamed sinks of the same type are named after their type and position, e.g. "webhook-2",
+    since delivery results are keyed by sink name. Raises ValueError if two sinks share a name.
+    
+    """
+    
+    sink_configs = None
+    try:
+        sink_configs = credentials.get_credential("notifications", "sinks", optional=True)
+    except:
+        raise
+    
+    sink_configs = _name_sink_configs(sink_configs or DEFAULT_SINKS)
+    
+    result = []
+    with _sinks_lock:
+        for sink_config in sink_configs:
+            key = json.dumps(sink_config, sort_keys=True)
+            if key not in _sinks:
+                _sinks[key] = create_sink(sink_config)
+            result.append(_sinks[key])
+    
+    return result
+
+
+def _name_sink_configs(sink_configs):
+    type_counts = {}
+    for sink_config in sink_configs:
+        if not sink_config.get("name"):
+            type_counts[sink_config.get("type")] = type_counts.get(sink_config.get("type"), 0) + 1
+    
+    result = []
+    type_numbers = {}
+    for sink_config in sink_configs:
+        sink_type = sink_config.get("type")
+        if not sink_config.get("name") and type_counts[sink_type] > 1:
+            type_numbers[sink_type] = type_numbers.get(sink_type, 0) + 1
+            sink_config = dict(sink_config, name=f"{sink_type}-{type_numbers[sink_type]}")
+        result.append(sink_config)
+    
+    names = [sink_config.get("name") or sink_config.get("type") for sink_config in result]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise ValueError(f"Sink names must be unique: {', '.join(duplicates)}")
+    
+    return result
+
+
+def deliver(alerts_to_send, sinks, deadline=None, on_late_delivery=None):
+    """
+    Send each alert to every sink in parallel, waiting for each delivery at most its sink's timeout
+    from when the delivery starts.
+    
+    A slow or failing sink doesn't delay the other sinks or alerts. Deliveries still queued
+    when the deadline passes, or behind a sink whose every worker has timed out, are cancelled.
+    
+    Returns a list with a dict for each alert of sink name to True if it delivered the alert.
+    Raises ValueError if two sinks share a name.
+    
+    Args:
+        alerts_to_send: a list of Alerts
+        sinks: a list of Sinks
+        deadline: CycleDeadline after which no more deliveries are waited for, if any
+        on_late_delivery: function called with an Alert when a delivery succeeds after it was given up on
+    """
+    
+    names = [sink.name for sink in sinks]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Sink names must be unique: {', '.join(names)}")
+    
+    with tracing.span("sinks.deliver", alert_count=len(alerts_to_send), sink_count=len(sinks)) as span:
+        results = _deliver(alerts_to_send, sinks, deadline, on_late_delivery)
+        span.set_attribute("delivered_count", sum(1 for delivered in results if any(delivered.values())))
+    
+    return results
+
+
+class _Delivery(object):
+    """One alert sent to one sink, timed from when a worker starts it."""
+    
+    def __init__(self, sink, alert):
+        self.sink = sink
+        self.alert = alert
+        self.started = None
+        self.future = None
+    
+    
+    def run(self):
+        self.started = time.monotonic()
+        with tracing.span(f"sinks.{self.sink.name}", budget_id=self.alert.budget_id, queue_id=self.alert.queue_id, threshold=self.alert.threshold):
+            return self.sink.send(self.alert)
+    
+    
+    def timed_out(self, now):
+        return self.started is not None and now - self.started >= self.sink.timeout
+
+
+def _deliver(alerts_to_send, sinks, deadline, on_late_delivery):
+    deliveries = [[_Delivery(sink, alert) for sink in sinks] for alert in alerts_to_send]
+    for delivery in (delivery for alert_deliveries in deliveries for delivery in alert_deliveries):
+        delivery.future = delivery.sink.executor.submit(tracing.wrap(delivery.run))
+    
+    results = [{} for _ in alerts_to_send]
+    pending = {delivery.future: (index, delivery) for index, alert_deliveries in enumerate(deliveries) for delivery in alert_deliveries}
+    
+    while pending:
+        now = time.monotonic()
+        expired = deadline is not None and deadline.expired()
+        
+        # A sink is stalled when all of its workers are stuck in deliveries past their timeout
+        stuck = {}
+        for index, delivery in pending.values():
+            if delivery.timed_out(now) and not delivery.future.done():
+                stuck[delivery.sink] = stuck.get(delivery.sink, 0) + 1
+        
+        for future, (index, delivery) in list(pending.items()):
+            sink = delivery.sink
+            alert = delivery.alert
+            
+            if future.done():
+                del pending[future]
+                results[index][sink.name] = _get_delivery_result(delivery)
+                continue
+            
+            if delivery.timed_out(now):
+                logger.error(f"Sink {sink.name} timed out after {sink.timeout:.3g}s delivering budget: {alert.budget_id}")
+            elif expired:
+                logger.error(f"Cycle deadline passed before sink {sink.name} delivered budget: {alert.budget_id}")
+            elif delivery.started is None and stuck.get(sink, 0) >= sink.max_workers:
+                logger.error(f"Sink {sink.name} is stalled, skipping budget: {alert.budget_id}")
+            else:
+                continue
+            
+            del pending[future]
+            results[index][sink.name] = False
+            
+            # Drop the delivery if it hasn't started yet, or record it if it succeeds later,
+            # so an alert that was sent isn't sent again next cycle
+            if not future.cancel() and on_late_delivery:
+                future.add_done_callback(lambda future, delivery=delivery: _on_late_delivery(future, delivery, on_late_delivery))
+        
+        if pending:
+            wait(pending, timeout=DELIVERY_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+    
+    return [{sink.name: delivered[sink.name] for sink in sinks} for delivered in results]
+
+
+def _get_delivery_result(delivery):
+    try:
+        delivery.future.result()
+        return True
+    except alerts.UnroutableQueueError as e:
+        # Already reported when the queue was quarantined
+        logger.debug(f"Sink {delivery.sink.name} skipped budget {delivery.alert.budget_id}: {e}")
+    except:
+        logger.error(f"Sink {delivery.sink.name} failed delivering budget: {delivery.alert.budget_id}")
+        logger.error(traceback.format_exc())
+    return False
+
+
+def _on_late_delivery(future, delivery, on_late_delivery):
+    if future.cancelled() or future.exception() is not None:
+        return
+    
+    logger.warning(f"Sink {delivery.sink.name} delivered budget {delivery.alert.budget_id} after timing out")
+    try:
+        on_late_delivery(delivery.alert)
+    except:
+        logger.error(traceback.format_exc())
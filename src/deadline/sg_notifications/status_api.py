@@ -0,0 +1,275 @@
+import datetime
+import hashlib
+import http.server
+import json
+import logging
+import logutil
+import threading
+import time
+
+# Logging to file
+logutil.add_file_handler()
+logger = logging.getLogger(__name__)
+logger.setLevel(logutil.get_deadline_config_level())
+
+# Logging to stdout
+log_handler = logging.StreamHandler()
+log_fmt = logging.Formatter(
+    "%(asctime)s - [%(levelname)-7s] "
+    "[%(module)s:%(funcName)s:%(lineno)d] %(message)s"
+)
+log_handler.setFormatter(log_fmt)
+logger.addHandler(log_handler)
+
+
+DEFAULT_HOST = "127.0.0.1"
+BUDGETS_PATH = "/budgets"
+
+# Alert tier at which a budget counts as breached, its limit. Lower tiers are early warnings.
+BREACH_THRESHOLD = 100
+
+_snapshot = None
+_server = None
+
+
+class BudgetStatusSnapshot(object):
+    """
+    The latest budget status of every queue the notifier has scanned, kept in memory
+    and served by the status API without calling Deadline Cloud.
+    
+    """
+    
+    def __init__(self):
+        """
+        Create an empty BudgetStatusSnapshot.
+        
+        """
+        
+        self.queues = {}
+        self.version = 0
+        self.responses = {}
+        self.lock = threading.Lock()
+    
+    
+    def update_farm(self, studio_hostname, farm, queues, budgets, breaches):
+        """
+        Replace the status of every queue on a farm with the results of a completed farm scan.
+        
+        Args:
+            studio_hostname: Deadline Cloud studio web host name
+            farm: the scanned Farm record
+            queues: Queue records of the farm
+            budgets: every Budget record of the farm
+            breaches: Breach records for the farm's budgets
+        """
+        
+        updated_at = time.time()
+        tiers_reached = {breach.budget.budget_id: breach.threshold for breach in breaches}
+        
+        farm_queues = {}
+        for queue in queues:
+            farm_queues[queue.queue_id] = {
+                "studio_hostname": studio_hostname,
+                "farm_id": farm.farm_id,
+                "farm_name": farm.display_name,
+                "queue_id": queue.queue_id,
+                "queue_name": queue.display_name,
+                "default_budget_action": queue.default_budget_action,
+                "breached": False,
+                "budgets": [],
+                "updated_at": updated_at,
+            }
+        
+        for budget in budgets:
+            queue_status = farm_queues.get(budget.queue_id)
+            if queue_status is None:
+                continue
+            
+            limit = budget.approximate_dollar_limit
+            usage = budget.approximate_dollar_usage
+            tier_reached = tiers_reached.get(budget.budget_id)
+            queue_status["budgets"].append({
+                "budget_id": budget.budget_id,
+                "status": budget.status,
+                "approximate_dollar_limit": limit,
+                "approximate_dollar_usage": usage,
+                "percent_used": round(usage / limit * 100, 2) if limit else None,
+                "tier_reached": tier_reached,
+            })
+            if tier_reached is not None and tier_reached >= BREACH_THRESHOLD:
+                queue_status["breached"] = True
+        
+        with self.lock:
+            for queue_id in [queue_id for queue_id, status in self.queues.items() if status["farm_id"] == farm.farm_id]:
+                del self.queues[queue_id]
+            self.queues.update(farm_queues)
+            self.version += 1
+            self.responses = {}
+    
+    
+    def remove_missing_farms(self, studio_hostname, farm_ids):
+        """
+        Drop the queues of a studio's farms that no longer exist.
+        
+        Args:
+            studio_hostname: Deadline Cloud studio web host name
+            farm_ids: IDs of every current farm in the studio
+        """
+        
+        farm_ids = set(farm_ids)
+        with self.lock:
+            missing = [
+                queue_id for queue_id, status in self.queues.items()
+                if status["studio_hostname"] == studio_hostname and status["farm_id"] not in farm_ids
+            ]
+            if not missing:
+                return
+            for queue_id in missing:
+                del self.queues[queue_id]
+            self.version += 1
+            self.responses = {}
+        
+        logger.info(f"Removed {len(missing)} queues of deleted farms from the budget status")
+    
+    
+    def get_response(self, queue_id=None):
+        """
+        Returns a tuple of the JSON body, ETag and oldest update time for all queues or one queue,
+        or None if the queue isn't known.
+        
+        Bodies are serialized once per snapshot version.
+        
+        Args:
+            queue_id: Deadline Cloud queue ID, or None for every queue
+        """
+        
+        with self.lock:
+            response = self.responses.get(queue_id)
+            if response is not None:
+                return response
+            
+            if queue_id is None:
+                statuses = sorted(self.queues.values(), key=lambda status: status["queue_id"])
+            elif queue_id in self.queues:
+                statuses = [self.queues[queue_id]]
+            else:
+                return None
+            
+            oldest = min((status["updated_at"] for status in statuses), default=None)
+            data = [dict(status, updated_at=_format_time(status["updated_at"])) for status in statuses]
+            if queue_id is None:
+                data = {"queues": data}
+            else:
+                data = data[0]
+            
+            body = json.dumps(data, separators=(",", ":")).encode("utf-8")
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+            
+            response = (body, etag, oldest)
+            self.responses[queue_id] = response
+        
+        return response
+
+
+class _StatusRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serves GET /budgets and GET /budgets/<queue_id> from the snapshot."""
+    
+    def do_GET(self):
+        path = self.path.split("?", 1)[0].rstrip("/")
+        
+        response = None
+        if path == BUDGETS_PATH:
+            response = _snapshot.get_response()
+        elif path.startswith(BUDGETS_PATH + "/"):
+            response = _snapshot.get_response(path[len(BUDGETS_PATH) + 1:])
+        
+        if response is None:
+            self.send_error(404)
+            return
+        
+        body, etag, oldest = response
+        
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self._send_age(oldest)
+            self.end_headers()
+            return
+        
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("ETag", etag)
+        self._send_age(oldest)
+        self.end_headers()
+        self.wfile.write(body)
+    
+    
+    def _send_age(self, oldest):
+        # Age of the oldest data in the response, in seconds
+        if oldest is not None:
+            self.send_header("Age", str(max(0, int(time.time() - oldest))))
+    
+    
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+def _format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc).isoformat()
+
+
+def get_snapshot():
+    """
+    Returns the BudgetStatusSnapshot served by the status API, or None if the API isn't running.
+    
+    """
+    
+    return _snapshot
+
+
+def start_server(port, host=DEFAULT_HOST):
+    """
+    Start serving the read-only budget status API in a background thread.
+    
+    Returns the running HTTP server.
+    
+    Args:
+        port: TCP port to listen on, or 0 for any free port
+        host: address to listen on, by default only the local host
+    """
+    
+    global _snapshot, _server
+    
+    if _server is not None:
+        return _server
+    
+    _snapshot = BudgetStatusSnapshot()
+    _server = http.server.ThreadingHTTPServer((host, port), _StatusRequestHandler)
+    _server.daemon_threads = True
+    
+    thread = threading.Thread(target=_server.serve_forever, name="status_api", daemon=True)
+    thread.start()
+    
+    logger.info(f"Serving budget status on http://{host}:{_server.server_port}{BUDGETS_PATH}")
+    
+    return _server
+
+
+def stop_server():
+    """
+    Stop the budget status API.
+    
+    """
+    
+    global _snapshot, _server
+    
+    if _server is None:
+        return
+    
+    _server.shutdown()
+    _server.server_close()
+    _server = None
+    _snapshot = None
@@ -2,8 +2,11 @@ import json
 import logging
 import logutil
 import os
+import threading
 import traceback
 
+import tracing
+
 # Logging to file
 logutil.add_file_handler()
 logger = logging.getLogger(__name__)
@@ -21,22 +24,29 @@ logger.addHandler(log_handler)
 
 DATA_PATH = "~/.deadline/notifications/notification_data.json"
 
+# Serializes read-modify-write updates from background threads, and reads against them, since
+# replacing a file that's open for reading fails on Windows
+_update_lock = threading.RLock()
+
 
-def get_stored_data():
+def get_stored_data(data_path=None):
     """Returns a dictionary containing the notifier's stored data.
     Data is stored as JSON.
     
+    Args:
+        data_path: JSON file to read. Defaults to the notifier's alert data at DATA_PATH.
     """
     
     data = {}
     
-    data_path = os.path.normpath(os.path.expanduser(DATA_PATH))
+    data_path = os.path.normpath(os.path.expanduser(data_path or DATA_PATH))
     
-    with open(data_path, "r") as f:
-        try:
-            data = json.loads(f.read())
-        except Exception as e:
-            logger.exception(e)
+    with tracing.span("storage.read", file=os.path.basename(data_path)), _update_lock:
+        with open(data_path, "r") as f:
+            try:
+                data = json.loads(f.read())
+            except Exception as e:
+                logger.exception(e)
     
     if not data:
         data = {}
@@ -46,36 +56,64 @@ def get_stored_data():
     return data
 
 
-def update_stored_data(data):
+def update_stored_data(data, data_path=None):
     """Updates the notifier's stored data with the given dictionary contents.
+    Raises an exception if the data can't be written, leaving the stored data unchanged.
     
     Args:
         data: A dictionary of data to insert or update into the notifier stored data.
+        data_path: JSON file to update. Defaults to the notifier's alert data at DATA_PATH.
     """
     
-    # logger.debug(f"data: {data}")
-    data_path = os.path.normpath(os.path.expanduser(DATA_PATH))
-    
-    data_stored = {}
-    try:
-        data_stored = get_stored_data()
-    except:
-        logger.error("Couldn't read stored data")
-        logger.error(traceback.format_exc())
+    return merge_stored_data(lambda data_stored: data, data_path)
+
+
+def merge_stored_data(merge, data_path=None):
+    """Updates the notifier's stored data with the dictionary returned by merge, which is called
+    with the stored data while other updates wait, so an update computed from the stored data
+    can't overwrite a concurrent one.
+    Raises an exception if the data can't be written, leaving the stored data unchanged.
     
-    data_stored.update(data)
+    Args:
+        merge: A function taking the stored data and returning a dictionary of data to insert or update.
+        data_path: JSON file to update. Defaults to the notifier's alert data at DATA_PATH.
+    """
     
-    try:
-        if not os.path.exists(os.path.dirname(data_path)):
-            os.makedirs(os.path.dirname(data_path))
-    except Exception as e:
-        logger.exception(e)
+    data_path = os.path.normpath(os.path.expanduser(data_path or DATA_PATH))
     
-    with open(data_path, "w") as f:
+    # The span includes waiting for other threads' updates
+    with tracing.span("storage.write", file=os.path.basename(data_path)) as span, _update_lock:
+        data_stored = {}
+        try:
+            data_stored = get_stored_data(data_path)
+        except FileNotFoundError:
+            pass
+        except:
+            logger.error("Couldn't read stored data")
+            logger.error(traceback.format_exc())
+        
+        data = merge(data_stored)
+        span.set_attribute("key_count", len(data))
+        data_stored.update(data)
+        
         try:
-            result = f.write(json.dumps(data_stored, indent=4))
+            if not os.path.exists(os.path.dirname(data_path)):
+                os.makedirs(os.path.dirname(data_path))
         except Exception as e:
             logger.exception(e)
+        
+        # Write to a temporary file first and only replace the stored data once the write
+        # succeeded, so a failed or interrupted write can't corrupt it
+        temp_path = f"{data_path}.tmp"
+        try:
+            with open(temp_path, "w") as f:
+                result = f.write(json.dumps(data_stored, indent=4))
+            os.replace(temp_path, data_path)
+        except:
+            logger.error(f"Couldn't write stored data: {data_path}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
     
     return result
 
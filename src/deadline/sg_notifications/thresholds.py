@@ -0,0 +1,185 @@
+import logging
+import logutil
+from dataclasses import dataclass
+
+import credentials
+import records
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Logging to file
+logutil.add_file_handler()
+logger = logging.getLogger(__name__)
+logger.setLevel(logutil.get_deadline_config_level())
+
+# Logging to stdout
+log_handler = logging.StreamHandler()
+log_fmt = logging.Formatter(
+    "%(asctime)s - [%(levelname)-7s] "
+    "[%(module)s:%(funcName)s:%(lineno)d] %(message)s"
+)
+log_handler.setFormatter(log_fmt)
+logger.addHandler(log_handler)
+
+
+# Alert tiers as percentages of a budget's limit. 100 alerts when usage reaches the limit.
+DEFAULT_THRESHOLDS = (100,)
+
+
+@dataclass(frozen=True, slots=True)
+class Breach:
+    """
+    A budget whose usage has reached one of its alert tiers.
+    
+    """
+    
+    budget: records.Budget
+    threshold: float
+
+
+class ThresholdEngine(object):
+    """
+    Evaluates budgets against one or more alert tiers, configured studio-wide
+    and optionally overridden per budget or per queue.
+    
+    """
+    
+    def __init__(self, thresholds=None, overrides=None):
+        """
+        Create a ThresholdEngine.
+        
+        Args:
+            thresholds: alert tiers as percentages of a budget's limit, e.g. [75, 90, 100]
+            overrides: a dict of budget ID or queue ID to the alert tiers for that budget or queue
+        """
+        
+        self.thresholds = normalize_thresholds(thresholds or DEFAULT_THRESHOLDS)
+        self.overrides = {key: normalize_thresholds(value) for key, value in (overrides or {}).items()}
+    
+    
+    @classmethod
+    def from_config(cls):
+        """
+        Returns a ThresholdEngine configured from the deadline_cloud section of the configuration file.
+        
+        """
+        
+        try:
+            thresholds = credentials.get_credential("deadline_cloud", "alert_thresholds")
+            overrides = credentials.get_credential("deadline_cloud", "alert_threshold_overrides")
+        except:
+            raise
+        
+        return cls(thresholds=thresholds, overrides=overrides)
+    
+    
+    def get_thresholds(self, budget):
+        """
+        Returns the sorted alert tiers for a budget.
+        
+        A budget ID override takes precedence over a queue ID override.
+        
+        Args:
+            budget: a Deadline Cloud Budget record
+        """
+        
+        if budget.budget_id in self.overrides:
+            return self.overrides[budget.budget_id]
+        if budget.queue_id in self.overrides:
+            return self.overrides[budget.queue_id]
+        return self.thresholds
+    
+    
+    def evaluate(self, budgets):
+        """
+        Find budgets which are marked ACTIVE and have usage that has met or exceeded one of their tiers.
+        
+        Every budget is evaluated in one pass over columnar usage and limit arrays,
+        using NumPy when it is installed.
+        
+        Returns a list of Breach records holding the highest tier reached by each budget.
+        
+        Args:
+            budgets: a list of Deadline Cloud Budget records
+        """
+        
+        breaches = []
+        
+        # Budgets are ACTIVE or INACTIVE
+        active = [budget for budget in budgets if budget.status == "ACTIVE"]
+        if len(active) != len(budgets):
+            logger.debug(f"Skipping {len(budgets) - len(active)} budgets that aren't ACTIVE")
+        
+        # Group budgets by their tiers so each group is evaluated against one tier array
+        groups = {}
+        for index, budget in enumerate(active):
+            groups.setdefault(self.get_thresholds(budget), []).append(index)
+        
+        # Usage is scaled by 100 and compared against limit * tier,
+        # so a budget exactly at a tier is counted as reaching it
+        if numpy is not None:
+            usages = numpy.fromiter((b.approximate_dollar_usage for b in active), dtype=float, count=len(active)) * 100.0
+            limits = numpy.fromiter((b.approximate_dollar_limit for b in active), dtype=float, count=len(active))
+            count_tiers_reached = _count_tiers_reached_numpy
+        else:
+            usages = [budget.approximate_dollar_usage * 100.0 for budget in active]
+            limits = [budget.approximate_dollar_limit for budget in active]
+            count_tiers_reached = _count_tiers_reached
+        
+        for thresholds, indexes in groups.items():
+            tiers_reached = count_tiers_reached(usages, limits, indexes, thresholds)
+            
+            for index, reached in zip(indexes, tiers_reached):
+                if reached:
+                    breaches.append(Breach(budget=active[index], threshold=thresholds[reached - 1]))
+        
+        return breaches
+
+
+def normalize_thresholds(thresholds):
+    """
+    Returns alert tiers as a sorted tuple of unique positive percentages.
+    
+    Args:
+        thresholds: a list of alert tiers as percentages of a budget's limit
+    """
+    
+    result = tuple(sorted({float(threshold) for threshold in thresholds}))
+    if not result or result[0] <= 0:
+        raise ValueError(f"Alert thresholds must be positive percentages: {thresholds}")
+    
+    return result
+
+
+def format_threshold(threshold):
+    """
+    Returns an alert tier formatted as a percentage, e.g. "75%".
+    
+    Args:
+        threshold: alert tier as a percentage of a budget's limit
+    """
+    
+    return "{:g}%".format(threshold)
+
+
+def _count_tiers_reached_numpy(usages, limits, indexes, thresholds):
+    if len(indexes) == len(usages):
+        usage, limit = usages, limits
+    else:
+        usage, limit = usages[indexes], limits[indexes]
+    tiers = numpy.asarray(thresholds, dtype=float)
+    
+    return (usage[:, None] >= limit[:, None] * tiers[None, :]).sum(axis=1).tolist()
+
+
+def _count_tiers_reached(usages, limits, indexes, thresholds):
+    tiers_reached = []
+    for index in indexes:
+        usage = usages[index]
+        limit = limits[index]
+        tiers_reached.append(sum(1 for threshold in thresholds if usage >= limit * threshold))
+    
+    return tiers_reached
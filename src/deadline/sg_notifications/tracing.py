@@ -0,0 +1,476 @@
+import contextvars
+import datetime
+import json
+import logging
+import logutil
+import os
+import random
+import threading
+import time
+import traceback
+
+import credentials
+
+# Logging to file
+logutil.add_file_handler()
+logger = logging.getLogger(__name__)
+logger.setLevel(logutil.get_deadline_config_level())
+
+# Logging to stdout
+log_handler = logging.StreamHandler()
+log_fmt = logging.Formatter(
+    "%(asctime)s - [%(levelname)-7s] "
+    "[%(module)s:%(funcName)s:%(lineno)d] %(message)s"
+)
+log_handler.setFormatter(log_fmt)
+logger.addHandler(log_handler)
+
+
+TRACES_PATH = "~/.deadline/notifications/traces"
+
+# Fraction of cycles traced. Tracing is off unless it's configured.
+DEFAULT_SAMPLE_RATE = 0.0
+
+# Spans kept per trace, so a runaway cycle can't exhaust memory
+MAX_SPANS_PER_TRACE = 50000
+
+# Chrome trace files kept in the traces directory
+MAX_TRACE_FILES = 100
+
+# Size at which spans.jsonl is rotated to spans.jsonl.1, and the rotated files kept
+MAX_JSONL_BYTES = 64 * 1024 * 1024
+MAX_JSONL_FILES = 5
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span(object):
+    """
+    A timed operation within a trace, with attributes such as a farm ID or budget count.
+    
+    Used as a context manager, which makes it the parent of spans started inside it.
+    
+    """
+    
+    __slots__ = ("tracer", "name", "trace_id", "span_id", "parent_id", "start_ns", "end_ns",
+                 "thread_id", "thread_name", "attributes", "error", "token")
+    
+    def __init__(self, tracer, name, trace_id, parent_id=None, attributes=None):
+        """
+        Create a Span, starting now.
+        
+        Args:
+            tracer: the Tracer the span is exported through
+            name: operation name, e.g. "deadline.list_budgets"
+            trace_id: ID of the trace the span belongs to
+            parent_id: ID of the parent span, or None for the root span of a trace
+            attributes: dict of attributes of the operation
+        """
+        
+        thread = threading.current_thread()
+        
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.thread_id = thread.ident
+        self.thread_name = thread.name
+        self.attributes = attributes or {}
+        self.error = None
+        self.token = None
+    
+    
+    def set_attribute(self, key, value):
+        """
+        Set an attribute of the span.
+        
+        Args:
+            key: attribute name
+            value: JSON serializable attribute value
+        """
+        
+        self.attributes[key] = value
+    
+    
+    def set_attributes(self, **attributes):
+        """
+        Set several attributes of the span.
+        
+        kwargs:
+            attribute names and JSON serializable values
+        """
+        
+        self.attributes.update(attributes)
+    
+    
+    def to_dict(self):
+        """
+        Returns the span as a dict of JSON serializable values.
+        
+        """
+        
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "thread_id": self.thread_id,
+            "thread_name": self.thread_name,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+    
+    
+    def __enter__(self):
+        self.token = _current_span.set(self)
+        return self
+    
+    
+    def __exit__(self, exc_type, exc_value, tb):
+        _current_span.reset(self.token)
+        if exc_type is not None:
+            self.error = f"{exc_type.__name__}: {exc_value}"
+        self.end_ns = time.time_ns()
+        self.tracer.finish(self)
+        return False
+
+
+class _NoopSpan(object):
+    """Stands in for a Span when a cycle isn't sampled, recording nothing."""
+    
+    __slots__ = ()
+    
+    def set_attribute(self, key, value):
+        pass
+    
+    
+    def set_attributes(self, **attributes):
+        pass
+    
+    
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Exporter(object):
+    """
+    A destination for finished traces. Subclasses implement export().
+    
+    """
+    
+    type_name = None
+    
+    def __init__(self, path=None):
+        """
+        Create an Exporter.
+        
+        Args:
+            path: directory the traces are written to. Defaults to TRACES_PATH.
+        """
+        
+        self.path = os.path.normpath(os.path.expanduser(path or TRACES_PATH))
+    
+    
+    def export(self, spans):
+        """
+        Write the spans of a finished trace.
+        
+        Args:
+            spans: list of the trace's finished Spans
+        """
+        
+        raise NotImplementedError
+    
+    
+    def _makedirs(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+
+class JsonlExporter(Exporter):
+    """
+    Appends every span as a line of JSON to spans.jsonl in the traces directory.
+    
+    Once the file reaches MAX_JSONL_BYTES it's renamed to spans.jsonl.1, older files shifting
+    to spans.jsonl.2 and so on, keeping MAX_JSONL_FILES rotated files.
+    
+    """
+    
+    type_name = "jsonl"
+    
+    def export(self, spans):
+        self._makedirs()
+        jsonl_path = os.path.join(self.path, "spans.jsonl")
+        self._rotate(jsonl_path)
+        with open(jsonl_path, "a") as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), separators=(",", ":"), default=str) + "\n")
+    
+    
+    def _rotate(self, jsonl_path):
+        try:
+            if os.path.getsize(jsonl_path) < MAX_JSONL_BYTES:
+                return
+        except FileNotFoundError:
+            return
+        
+        for number in range(MAX_JSONL_FILES - 1, 0, -1):
+            if os.path.exists(f"{jsonl_path}.{number}"):
+                os.replace(f"{jsonl_path}.{number}", f"{jsonl_path}.{number + 1}")
+        os.replace(jsonl_path, f"{jsonl_path}.1")
+
+
+class ChromeTraceExporter(Exporter):
+    """
+    Writes each trace to its own file in the Chrome trace event format, which opens
+    as a flame chart in Perfetto (ui.perfetto.dev) or chrome://tracing.
+    
+    """
+    
+    type_name = "chrome"
+    
+    def export(self, spans):
+        self._makedirs()
+        
+        pid = os.getpid()
+        events = []
+        thread_names = {}
+        for span in spans:
+            thread_names[span.thread_id] = span.thread_name
+            args = dict(span.attributes, span_id=span.span_id, parent_id=span.parent_id)
+            if span.error:
+                args["error"] = span.error
+            events.append({
+                "name": span.name,
+                "cat": span.name.split(".", 1)[0],
+                "ph": "X",
+                "ts": span.start_ns / 1000,
+                "dur": (span.end_ns - span.start_ns) / 1000,
+                "pid": pid,
+                "tid": span.thread_id,
+                "args": args,
+            })
+        for thread_id, thread_name in thread_names.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": thread_id, "args": {"name": thread_name}})
+        
+        root = min(spans, key=lambda span: span.start_ns)
+        started = datetime.datetime.fromtimestamp(root.start_ns / 1e9).strftime("%Y%m%d-%H%M%S")
+        trace_path = os.path.join(self.path, f"trace-{started}-{root.trace_id[:8]}.json")
+        with open(trace_path, "w") as f:
+            f.write(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}, separators=(",", ":"), default=str))
+        
+        self._remove_old_traces()
+    
+    
+    def _remove_old_traces(self):
+        trace_files = sorted(name for name in os.listdir(self.path) if name.startswith("trace-") and name.endswith(".json"))
+        for name in trace_files[:-MAX_TRACE_FILES]:
+            os.remove(os.path.join(self.path, name))
+
+
+EXPORTER_TYPES = {exporter_type.type_name: exporter_type for exporter_type in (JsonlExporter, ChromeTraceExporter)}
+
+
+class Tracer(object):
+    """
+    Starts spans for sampled notifier cycles and hands each finished trace to an exporter.
+    
+    """
+    
+    def __init__(self, exporter=None, sample_rate=None):
+        """
+        Create a Tracer.
+        
+        Args:
+            exporter: Exporter finished traces are written to, by default a ChromeTraceExporter
+            sample_rate: fraction of traces recorded, from 0 to 1
+        """
+        
+        self.exporter = exporter or ChromeTraceExporter()
+        self.sample_rate = DEFAULT_SAMPLE_RATE if sample_rate is None else sample_rate
+        self.traces = {}
+        self.lock = threading.Lock()
+    
+    
+    @classmethod
+    def from_config(cls, sample_rate=None, path=None):
+        """
+        Returns a Tracer configured from the tracing section of the configuration file.
+        
+        Args:
+            sample_rate: fraction of traces recorded, overriding the configuration file
+            path: directory traces are written to, overriding the configuration file
+        """
+        
+        try:
+            config_sample_rate = credentials.get_credential("tracing", "sample_rate", optional=True)
+            exporter_type = credentials.get_credential("tracing", "exporter", optional=True) or ChromeTraceExporter.type_name
+            config_path = credentials.get_credential("tracing", "path", optional=True)
+        except:
+            raise
+        
+        if exporter_type not in EXPORTER_TYPES:
+            raise ValueError(f"Unknown trace exporter type: {exporter_type}")
+        
+        return cls(
+            exporter=EXPORTER_TYPES[exporter_type](path=path or config_path),
+            sample_rate=config_sample_rate if sample_rate is None else sample_rate
+        )
+    
+    
+    def start_span(self, name, root=False, **attributes):
+        """
+        Returns a Span that is a child of the current span, or NOOP_SPAN if there's nothing to record.
+        
+        Args:
+            name: operation name
+            root: if True, start a new trace when there's no current span, subject to sampling
+        
+        kwargs:
+            attributes of the span
+        """
+        
+        parent = _current_span.get()
+        if parent is None:
+            if not root or not self.sample_rate or random.random() >= self.sample_rate:
+                return NOOP_SPAN
+            trace_id = os.urandom(16).hex()
+            with self.lock:
+                self.traces[trace_id] = []
+            return Span(self, name, trace_id, attributes=attributes)
+        
+        if parent.tracer is not self:
+            return NOOP_SPAN
+        
+        return Span(self, name, parent.trace_id, parent_id=parent.span_id, attributes=attributes)
+    
+    
+    def finish(self, span):
+        """
+        Record a finished span, exporting its trace when the trace's root span finishes.
+        
+        Spans that finish after their root span are dropped.
+        
+        Args:
+            span: the finished Span
+        """
+        
+        with self.lock:
+            spans = self.traces.get(span.trace_id)
+            if spans is None:
+                return
+            if span.parent_id is not None:
+                if len(spans) < MAX_SPANS_PER_TRACE:
+                    spans.append(span)
+                return
+            del self.traces[span.trace_id]
+        
+        spans.append(span)
+        try:
+            self.exporter.export(spans)
+            logger.debug(f"Exported {len(spans)} spans of trace: {span.trace_id}")
+        except:
+            logger.error("Couldn't export trace")
+            logger.error(traceback.format_exc())
+
+
+class TracedClient(object):
+    """Wraps a service client so each method call is recorded as a span named after the service and method."""
+    
+    def __init__(self, client, service):
+        self._client = client
+        self._service = service
+    
+    
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute):
+            return attribute
+        
+        def traced(*args, **kwargs):
+            with span(f"{self._service}.{name}") as call_span:
+                if args and isinstance(args[0], str):
+                    call_span.set_attribute("entity_type", args[0])
+                result = attribute(*args, **kwargs)
+                if isinstance(result, list):
+                    call_span.set_attribute("result_count", len(result))
+                return result
+        
+        return traced
+
+
+_tracer = Tracer(sample_rate=0)
+
+
+def get_tracer():
+    """
+    Returns the process-wide Tracer.
+    
+    """
+    
+    return _tracer
+
+
+def set_tracer(tracer):
+    """
+    Replace the process-wide Tracer.
+    
+    Args:
+        tracer: the Tracer spans are started from
+    """
+    
+    global _tracer
+    
+    _tracer = tracer
+    logger.debug(f"Tracing {tracer.sample_rate:.0%} of cycles with exporter: {tracer.exporter.type_name}")
+
+
+def span(name, root=False, **attributes):
+    """
+    Returns a span context manager for an operation, from the process-wide Tracer.
+    
+    Spans are only recorded inside a sampled trace, which is started by a span with root=True.
+    
+    Args:
+        name: operation name, e.g. "budgets.run"
+        root: if True, start a new trace when there's no current span, subject to sampling
+    
+    kwargs:
+        attributes of the span
+    """
+    
+    return _tracer.start_span(name, root=root, **attributes)
+
+
+def wrap(func):
+    """
+    Returns func bound to the current span, so spans it starts on another thread join the current trace.
+    
+    Args:
+        func: function to run on another thread, e.g. through a ThreadPoolExecutor
+    """
+    
+    parent = _current_span.get()
+    if parent is None:
+        return func
+    
+    def wrapped(*args, **kwargs):
+        token = _current_span.set(parent)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current_span.reset(token)
+    
+    return wrapped
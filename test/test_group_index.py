@@ -0,0 +1,113 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "deadline", "sg_notifications"))
+
+import group_index
+
+
+class _FakeShotgun(object):
+    """ShotGrid stand-in serving Groups and Group events, optionally failing Group finds."""
+    
+    def __init__(self, groups, events=None):
+        self.groups = groups
+        self.events = events or []
+        self.fail_group_finds = 0
+    
+    
+    def find_one(self, entity_type, filters=None, fields=None, order=None):
+        events = sorted(self.events, key=lambda event: event["id"], reverse=True)
+        return events[0] if events else None
+    
+    
+    def find(self, entity_type, filters=None, fields=None, order=None, limit=0):
+        if entity_type == "EventLogEntry":
+            cursor = filters[0][2]
+            return [event for event in self.events if event["id"] > cursor]
+        
+        if self.fail_group_finds:
+            self.fail_group_finds -= 1
+            raise ConnectionError("ShotGrid unavailable")
+        
+        group_ids = next((condition[2] for condition in filters if condition[0] == "id"), None)
+        return [
+            dict(group) for group in self.groups
+            if group_ids is None or group["id"] in group_ids
+        ]
+
+
+def make_group(group_id, code, project=None):
+    return {"type": "Group", "id": group_id, "code": code, "sg_group_project": project}
+
+
+class TestGroupIndexPoll(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.sg = _FakeShotgun(
+            groups=[make_group(1, "DeadlineCloud queue:Comp queue-id:queue-comp")],
+            events=[{"id": 10, "event_type": "Shotgun_Group_New", "entity": {"type": "Group", "id": 1}}]
+        )
+        self.index = group_index.GroupIndex(
+            get_shotgun=lambda: self.sg,
+            code_filter="DeadlineCloud",
+            fields=["code", "sg_group_project"],
+            index_path=os.path.join(self.directory.name, "group_index.json"),
+            poll_interval=0
+        )
+        self.index.get_groups()
+    
+    
+    def tearDown(self):
+        self.directory.cleanup()
+    
+    
+    def change_group(self, event_id, group):
+        self.sg.groups = [group]
+        self.sg.events.append({"id": event_id, "event_type": "Shotgun_Group_Change", "entity": {"type": "Group", "id": group["id"]}})
+    
+    
+    def test_poll_applies_changed_groups(self):
+        changed = []
+        self.index.add_listener(changed.extend)
+        self.change_group(11, make_group(1, "DeadlineCloud queue:Comp queue-id:queue-comp", {"type": "Project", "id": 2}))
+        
+        self.assertEqual(self.index.poll(), 1)
+        
+        self.assertEqual(self.index.cursor, 11)
+        self.assertEqual(self.index.groups[1]["sg_group_project"], {"type": "Project", "id": 2})
+        self.assertEqual([group["id"] for group in changed], [1])
+    
+    
+    def test_failed_group_fetch_keeps_index_and_cursor(self):
+        self.change_group(11, make_group(1, "DeadlineCloud queue:Comp queue-id:queue-comp", {"type": "Project", "id": 2}))
+        self.sg.fail_group_finds = 1
+        
+        self.assertEqual(self.index.poll(), 0)
+        
+        self.assertEqual(self.index.cursor, 10)
+        self.assertEqual(list(self.index.groups), [1])
+        self.assertIsNone(self.index.groups[1]["sg_group_project"])
+        
+        # The next poll reads the same events again and applies them
+        self.assertEqual(self.index.poll(), 1)
+        self.assertEqual(self.index.cursor, 11)
+        self.assertEqual(self.index.groups[1]["sg_group_project"], {"type": "Project", "id": 2})
+    
+    
+    def test_failed_reload_keeps_index(self):
+        def fail_events(*args, **kwargs):
+            raise ConnectionError("ShotGrid unavailable")
+        
+        self.sg.find_one = fail_events
+        self.sg.events = None
+        
+        self.assertEqual(self.index.poll(), 0)
+        
+        self.assertEqual(self.index.cursor, 10)
+        self.assertEqual(list(self.index.groups), [1])
+
+
+if __name__ == "__main__":
+    unittest.main()
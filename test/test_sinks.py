@@ -0,0 +1,231 @@
+import http.server
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "deadline", "sg_notifications"))
+
+import sinks
+
+
+def make_alert(budget_id="budget-example"):
+    return sinks.Alert(
+        farm_id="farm-example",
+        farm_name="Example Farm",
+        farm_hostname="studio.example.deadlinecloud.amazonaws.com",
+        queue_id="queue-example",
+        queue_name="Example Queue",
+        budget_id=budget_id,
+        budget_limit=1000.0,
+        default_budget_action="NONE",
+        threshold=100
+    )
+
+
+class _WebhookHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append((dict(self.headers), json.loads(body)))
+        self.send_response(200)
+        self.end_headers()
+    
+    
+    def log_message(self, format, *args):
+        pass
+
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    """Minimal SMTP stand-in that keeps each message it receives."""
+    
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode("ascii"))
+    
+    
+    def handle(self):
+        self.reply("220 localhost SMTP stand-in")
+        message = None
+        while True:
+            line = self.rfile.readline().decode("utf-8")
+            if not line:
+                return
+            command = line.strip().upper()
+            if message is not None:
+                if line.rstrip("\r\n") == ".":
+                    self.server.messages.append(message)
+                    message = None
+                    self.reply("250 OK")
+                else:
+                    message += line
+            elif command.startswith("EHLO") or command.startswith("HELO"):
+                self.reply("250 localhost")
+            elif command == "DATA":
+                message = ""
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class _ThreadingServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _SleepingSink(sinks.Sink):
+    type_name = "sleeping"
+    
+    def __init__(self, delay, **kwargs):
+        super().__init__(**kwargs)
+        self.delay = delay
+        self.sent = []
+        self.lock = threading.Lock()
+    
+    
+    def send(self, alert):
+        time.sleep(self.delay)
+        with self.lock:
+            self.sent.append(alert.budget_id)
+
+
+class TestWebhookSink(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _WebhookHandler)
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/hook"
+    
+    
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+    
+    
+    def test_slack_payload(self):
+        sink = sinks.WebhookSink(url=self.url, headers={"X-Example": "1"})
+        self.assertEqual(sink.send(make_alert()), 200)
+        
+        headers, body = self.server.requests[0]
+        self.assertEqual(list(body), ["text"])
+        self.assertIn("Example Queue", body["text"])
+        self.assertEqual(headers["X-Example"], "1")
+    
+    
+    def test_json_payload(self):
+        sink = sinks.WebhookSink(url=self.url, payload="json")
+        sink.send(make_alert())
+        
+        headers, body = self.server.requests[0]
+        self.assertEqual(body["budget_id"], "budget-example")
+        self.assertEqual(body["budget_limit"], 1000.0)
+        self.assertIn("subject", body)
+
+
+class TestSmtpSink(unittest.TestCase):
+    def setUp(self):
+        self.server = _ThreadingServer(("127.0.0.1", 0), _SmtpHandler)
+        self.server.messages = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    
+    
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+    
+    
+    def test_send(self):
+        sink = sinks.SmtpSink(
+            host="127.0.0.1",
+            port=self.server.server_address[1],
+            sender="notifier@example.com",
+            recipients=["producers@example.com"]
+        )
+        sink.send(make_alert())
+        
+        self.assertEqual(len(self.server.messages), 1)
+        self.assertIn("To: producers@example.com", self.server.messages[0])
+        self.assertIn("Example Queue", self.server.messages[0])
+
+
+class TestDeliver(unittest.TestCase):
+    def test_queued_deliveries_are_timed_from_their_start(self):
+        # 12 deliveries of 0.1s on 2 workers take 0.6s, longer than the 0.3s timeout of each
+        sink = _SleepingSink(0.1, name="slow", timeout=0.3, max_workers=2)
+        alerts_to_send = [make_alert(f"budget-{i}") for i in range(12)]
+        
+        results = sinks.deliver(alerts_to_send, [sink])
+        
+        self.assertEqual(results, [{"slow": True}] * 12)
+        self.assertEqual(len(sink.sent), 12)
+    
+    
+    def test_hung_sink_does_not_delay_other_sinks(self):
+        fast = _SleepingSink(0, name="fast")
+        hung = _SleepingSink(1.0, name="hung", timeout=0.2, max_workers=2)
+        alerts_to_send = [make_alert(f"budget-{i}") for i in range(6)]
+        late = []
+        
+        started = time.monotonic()
+        results = sinks.deliver(alerts_to_send, [fast, hung], on_late_delivery=late.append)
+        elapsed = time.monotonic() - started
+        
+        self.assertLess(elapsed, 0.9)
+        self.assertEqual(results, [{"fast": True, "hung": False}] * 6)
+        self.assertEqual(len(fast.sent), 6)
+        
+        # The two deliveries that were running finish later and are reported, the queued ones never run
+        time.sleep(1.2)
+        self.assertEqual(sorted(alert.budget_id for alert in late), sorted(hung.sent))
+        self.assertEqual(len(hung.sent), 2)
+    
+    
+    def test_failing_sink(self):
+        class FailingSink(sinks.Sink):
+            type_name = "failing"
+            
+            def send(self, alert):
+                raise RuntimeError("unavailable")
+        
+        results = sinks.deliver([make_alert()], [FailingSink(), _SleepingSink(0, name="fast")])
+        
+        self.assertEqual(results, [{"failing": False, "fast": True}])
+    
+    
+    def test_duplicate_sink_names(self):
+        with self.assertRaises(ValueError):
+            sinks.deliver([make_alert()], [_SleepingSink(0), _SleepingSink(0)])
+
+
+class TestGetSinks(unittest.TestCase):
+    def get_sinks(self, sink_configs):
+        with mock.patch.object(sinks.credentials, "get_credential", return_value=sink_configs):
+            return sinks.get_sinks()
+    
+    
+    def test_unnamed_sinks_of_one_type_get_unique_names(self):
+        result = self.get_sinks([
+            {"type": "shotgrid"},
+            {"type": "webhook", "url": "http://127.0.0.1:9/first"},
+            {"type": "webhook", "url": "http://127.0.0.1:9/second"},
+            {"type": "webhook", "url": "http://127.0.0.1:9/third", "name": "slack"},
+        ])
+        
+        self.assertEqual([sink.name for sink in result], ["shotgrid", "webhook-1", "webhook-2", "slack"])
+    
+    
+    def test_duplicate_names_are_rejected(self):
+        with self.assertRaises(ValueError):
+            self.get_sinks([
+                {"type": "webhook", "url": "http://127.0.0.1:9/first", "name": "slack"},
+                {"type": "webhook", "url": "http://127.0.0.1:9/second", "name": "slack"},
+            ])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "deadline", "sg_notifications"))
+
+import storage
+
+
+class TestUpdateStoredData(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.data_path = os.path.join(self.directory.name, "notification_data.json")
+    
+    
+    def tearDown(self):
+        self.directory.cleanup()
+    
+    
+    def test_update_merges_with_stored_data(self):
+        storage.update_stored_data({"budget-a": {"thresholds": [100]}}, self.data_path)
+        storage.update_stored_data({"budget-b": {"thresholds": [75]}}, self.data_path)
+        
+        self.assertEqual(storage.get_stored_data(self.data_path), {
+            "budget-a": {"thresholds": [100]},
+            "budget-b": {"thresholds": [75]},
+        })
+    
+    
+    def test_failed_write_keeps_stored_data(self):
+        storage.update_stored_data({"budget-a": {"thresholds": [100]}}, self.data_path)
+        
+        with mock.patch.object(storage.json, "dumps", side_effect=ValueError("not serializable")):
+            with self.assertRaises(ValueError):
+                storage.update_stored_data({"budget-b": {"thresholds": [75]}}, self.data_path)
+        
+        with open(self.data_path) as f:
+            self.assertEqual(json.loads(f.read()), {"budget-a": {"thresholds": [100]}})
+        self.assertEqual(os.listdir(self.directory.name), ["notification_data.json"])
+
+    
+    
+    def test_concurrent_merges_see_each_others_updates(self):
+        def add_tier(tier):
+            storage.merge_stored_data(
+                lambda data_stored: {"budget-a": sorted(data_stored.get("budget-a", []) + [tier])},
+                self.data_path
+            )
+        
+        threads = [threading.Thread(target=add_tier, args=(tier,)) for tier in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(storage.get_stored_data(self.data_path), {"budget-a": list(range(20))})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "deadline", "sg_notifications"))
+
+import records
+import thresholds
+
+
+def make_budget(budget_id, usage, limit=100.0, queue_id="queue-example", status="ACTIVE"):
+    return records.Budget(
+        budget_id=budget_id,
+        queue_id=queue_id,
+        status=status,
+        approximate_dollar_limit=limit,
+        approximate_dollar_usage=usage
+    )
+
+
+class _ThresholdEngineTests(object):
+    """Cases run against both the NumPy and the pure Python tier counting."""
+    
+    numpy = None
+    
+    def evaluate(self, engine, budgets):
+        with mock.patch.object(thresholds, "numpy", self.numpy):
+            return {breach.budget.budget_id: breach.threshold for breach in engine.evaluate(budgets)}
+    
+    
+    def test_tiers_at_exact_boundaries(self):
+        engine = thresholds.ThresholdEngine(thresholds=[75, 90, 100])
+        budgets = [
+            make_budget("below", 74.99),
+            make_budget("at-75", 75.0),
+            make_budget("at-90", 90.0),
+            make_budget("at-100", 100.0),
+            make_budget("over", 250.0),
+            make_budget("cents", 7.5, limit=10.0),
+        ]
+        
+        self.assertEqual(self.evaluate(engine, budgets), {
+            "at-75": 75.0,
+            "at-90": 90.0,
+            "at-100": 100.0,
+            "over": 100.0,
+            "cents": 75.0,
+        })
+    
+    
+    def test_default_tier_is_the_limit(self):
+        engine = thresholds.ThresholdEngine()
+        
+        self.assertEqual(self.evaluate(engine, [make_budget("under", 99.0), make_budget("at", 100.0)]), {"at": 100.0})
+    
+    
+    def test_budget_override_takes_precedence_over_queue_override(self):
+        engine = thresholds.ThresholdEngine(
+            thresholds=[100],
+            overrides={"queue-comp": [50], "budget-special": [80]}
+        )
+        budgets = [
+            make_budget("budget-default", 60.0),
+            make_budget("budget-comp", 60.0, queue_id="queue-comp"),
+            make_budget("budget-special", 60.0, queue_id="queue-comp"),
+            make_budget("budget-special-over", 85.0, queue_id="queue-other"),
+        ]
+        
+        self.assertEqual(self.evaluate(engine, budgets), {"budget-comp": 50.0})
+    
+    
+    def test_inactive_budgets_are_skipped(self):
+        engine = thresholds.ThresholdEngine(thresholds=[50, 100])
+        budgets = [
+            make_budget("inactive", 150.0, status="INACTIVE"),
+            make_budget("active", 60.0),
+        ]
+        
+        self.assertEqual(self.evaluate(engine, budgets), {"active": 50.0})
+    
+    
+    def test_no_budgets(self):
+        self.assertEqual(self.evaluate(thresholds.ThresholdEngine(thresholds=[50, 100]), []), {})
+
+
+class TestThresholdEngine(_ThresholdEngineTests, unittest.TestCase):
+    numpy = None
+
+
+@unittest.skipIf(thresholds.numpy is None, "NumPy isn't installed")
+class TestThresholdEngineNumpy(_ThresholdEngineTests, unittest.TestCase):
+    numpy = thresholds.numpy
+
+
+class TestNormalizeThresholds(unittest.TestCase):
+    def test_sorted_unique_floats(self):
+        self.assertEqual(thresholds.normalize_thresholds([100, 75, 75.0, 90]), (75.0, 90.0, 100.0))
+    
+    
+    def test_non_positive_tiers_are_rejected(self):
+        with self.assertRaises(ValueError):
+            thresholds.normalize_thresholds([0, 100])
+        with self.assertRaises(ValueError):
+            thresholds.normalize_thresholds([])
+
+
+if __name__ == "__main__":
+    unittest.main()